@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Laurent El Shafey <Laurent.El-Shafey@idiap.ch>
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches for the results of the queries to the Multi-PIE database.
+"""
+
+import os
+import contextlib
+import collections
+
+def permissions(mode):
+  """Returns the given permissions without the bits masked by the umask of the
+     process, i.e., those a newly created file would get"""
+  umask = os.umask(0)
+  os.umask(umask)
+  return mode & ~umask
+
+@contextlib.contextmanager
+def atomic_file(filename):
+  """Yields the name of a temporary file in the directory of filename, which
+     is renamed to filename when the block ends, so that readers never see a
+     partial file. The temporary file is removed if the block fails."""
+
+  import tempfile
+  fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp', dir=os.path.dirname(filename) or '.')
+  os.close(fd)
+  try:
+    yield tmpname
+    # mkstemp only gives access to the owner
+    os.chmod(tmpname, permissions(0o666))
+    os.rename(tmpname, filename)
+  except:
+    os.unlink(tmpname)
+    raise
+
+def atomic_write(filename, write):
+  """Calls write() with the name of a temporary file, which is then renamed to
+     filename, see atomic_file()"""
+
+  with atomic_file(filename) as tmpname:
+    write(tmpname)
+
+def file_stamp(filename):
+  """Returns the modification time and the size of the given file, which
+     change whenever the file is re-created"""
+  s = os.stat(filename)
+  return (s.st_mtime, s.st_size)
+
+class LRUCache(object):
+  """A cache of query results (lists), which evicts the least recently used
+     results when it holds more than max_entries results or, if given, more
+     than max_objects objects in all results together."""
+
+  def __init__(self, max_entries, max_objects = None):
+    self.m_max_entries = max_entries
+    self.m_max_objects = max_objects
+    self.m_entries = collections.OrderedDict()
+    self.m_objects = 0
+    self.m_hits = 0
+    self.m_misses = 0
+
+  def get(self, key, compute):
+    """Returns a copy of the result stored for the given key. If there is none,
+       it is computed by calling compute() and stored."""
+    if key in self.m_entries:
+      self.m_hits += 1
+      # move to the most recently used end
+      result = self.m_entries.pop(key)
+      self.m_entries[key] = result
+      return list(result)
+
+    self.m_misses += 1
+    result = compute()
+    if self.m_max_objects is None or len(result) <= self.m_max_objects:
+      self.m_entries[key] = tuple(result)
+      self.m_objects += len(result)
+      while len(self.m_entries) > self.m_max_entries or (self.m_max_objects is not None and self.m_objects > self.m_max_objects):
+        self.m_objects -= len(self.m_entries.popitem(last=False)[1])
+    return result
+
+  def clear(self):
+    """Removes all stored results; the counters are kept"""
+    self.m_entries.clear()
+    self.m_objects = 0
+
+  def info(self):
+    """Returns the counters and the current occupancy of the cache"""
+    return {'hits' : self.m_hits, 'misses' : self.m_misses, 'entries' : len(self.m_entries), 'objects' : self.m_objects,
+            'max_entries' : self.m_max_entries, 'max_objects' : self.m_max_objects}
+
+def database_fingerprint(filename):
+  """Returns a short fingerprint of the given SQLite database file, made of
+     its modification time, its size and its header, which contains a
+     counter of the changes to the database"""
+
+  import hashlib
+  s = os.stat(filename)
+  with open(filename, 'rb') as f:
+    header = f.read(100)
+  h = hashlib.sha1(('%r %d ' % (s.st_mtime, s.st_size)).encode('utf-8') + header)
+  return h.hexdigest()[:16]
+
+class FileListCache(object):
+  """A persistent cache of file lists on disk. Each list is stored as a
+     numpy array with two rows, the file ids and the client ids, in a
+     subdirectory named after the fingerprint of the database."""
+
+  def __init__(self, directory):
+    self.m_directory = directory
+
+  def filename(self, fingerprint, name):
+    """Returns the file that stores the list with the given name"""
+    return os.path.join(self.m_directory, fingerprint, name + '.npy')
+
+  def get(self, fingerprint, name, compute):
+    """Returns the list with the given name. If it is not stored yet, it is
+       computed by calling compute(), which returns (file id, client id) pairs,
+       and stored, if the cache directory is writable."""
+
+    import numpy
+    filename = self.filename(fingerprint, name)
+    if os.path.exists(filename):
+      return numpy.load(filename)
+    array = numpy.array(list(compute()), dtype=numpy.int32).reshape(-1, 2).T.copy()
+    self.store(filename, array)
+    return array
+
+  def store(self, filename, array):
+    """Writes the array to a temporary file first, so that concurrent jobs
+       never read a partial file"""
+
+    import numpy
+
+    def write(tmpname):
+      with open(tmpname, 'wb') as f:
+        numpy.save(f, array)
+
+    try:
+      if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+      atomic_write(filename, write)
+    except (IOError, OSError):
+      # e.g., the directory is not writable; the list is just not stored
+      pass
+
+  def remove_stale(self, fingerprint):
+    """Removes the lists stored for other fingerprints than the given one"""
+
+    import re
+    import shutil
+    if not os.path.isdir(self.m_directory):
+      return
+    for name in os.listdir(self.m_directory):
+      if name != fingerprint and re.match('^[0-9a-f]{16}$', name):
+        shutil.rmtree(os.path.join(self.m_directory, name))
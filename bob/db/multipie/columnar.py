@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Laurent El Shafey <Laurent.El-Shafey@idiap.ch>
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""The tables of the Multi-PIE database as numpy columns, which answer the
+queries of the Database class with boolean masks instead of SQL.
+"""
+
+import numpy
+from sqlalchemy import select
+
+from .models import *
+
+# numpy < 1.13 has no isin
+isin = getattr(numpy, 'isin', None) or numpy.in1d
+
+def world_nshots_limits(world_nshots):
+  """Returns the number of shots to keep from the first, second, third and
+     fourth recordings of the world clients, for the world_nshots option of
+     Database.objects(). Each recording holds 19 shots."""
+
+  max1 = 19
+  max2 = 19
+  max3 = 19
+  max4 = 19
+  if world_nshots < 19:
+    max1 = world_nshots
+    max2 = 0
+    max3 = 0
+    max4 = 0
+  elif world_nshots < 38:
+    max2 = world_nshots - 19
+    max3 = 0
+    max4 = 0
+  elif world_nshots < 57:
+    max3 = world_nshots - 38
+    max4 = 0
+  else:
+    max4 = world_nshots - 57
+  return max1, max2, max3, max4
+
+def string_dtype(values, char = None):
+  """Returns the numpy string type that holds the longest of the given strings,
+     with the given type character ('S' for byte strings), by default the one
+     of str"""
+  return '%s%d' % (char or numpy.dtype(str).char, max([len(v) for v in values] + [1]))
+
+def _text(values):
+  """Converts the given strings into a numpy string array, which, unlike object
+     arrays, can be memory-mapped"""
+  values = [str(v) for v in values]
+  return numpy.array(values, dtype=string_dtype(values))
+
+def _pack(groups):
+  """Concatenates the given arrays, returning the offsets of each of them in
+     the concatenated array"""
+  offsets = numpy.cumsum([0] + [len(g) for g in groups]).astype(numpy.int64)
+  values = numpy.concatenate([numpy.asarray(g, dtype=numpy.int64) for g in groups]) if groups else numpy.array([], dtype=numpy.int64)
+  return offsets, values
+
+class Columns(object):
+  """Holds the files, clients, subworlds and protocol purposes of a database
+     as numpy arrays. The files are sorted in the order of the results of
+     Database.objects(), i.e., by client, session, recording and file id.
+
+     The columns can be saved to a directory of .npy files with save() and
+     memory-mapped from there with load(), so that several processes share
+     the same pages."""
+
+  # the names of the arrays, which are stored in the m_<name> attributes
+  ARRAYS = ('client_id', 'client_sgroup', 'client_gender', 'client_birthyear',
+            'file_id', 'file_client_id', 'file_path', 'file_session_id', 'file_recording_id', 'file_expression_id', 'file_shot_id', 'file_camera_id', 'file_client_sessions',
+            'purpose_id', 'purpose_protocol', 'purpose_sgroup', 'purpose_purpose', 'purpose_offsets', 'purpose_files',
+            'subworld_name', 'subworld_offsets', 'subworld_clients',
+            'protocol_name', 'expression_id', 'expression_name', 'camera_id', 'camera_name')
+
+  def __init__(self, session):
+    # clients, sorted by id
+    rows = session.execute(select([Client.id, Client.sgroup, Client.gender, Client.birthyear, Client.first_session,
+        Client.second_session, Client.third_session, Client.fourth_session]).order_by(Client.id)).fetchall()
+    self.m_client_id = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+    self.m_client_sgroup = _text(r[1] for r in rows)
+    self.m_client_gender = _text(r[2] for r in rows)
+    self.m_client_birthyear = numpy.array([r[3] for r in rows], dtype=numpy.int64)
+    client_sessions = numpy.array([r[4:8] for r in rows], dtype=numpy.int64).reshape(-1, 4)
+
+    # files, with their multiview information (-1 for highres files)
+    f, mv = File.__table__, FileMultiview.__table__
+    rows = session.execute(select([f.c.id, f.c.client_id, f.c.session_id, f.c.recording_id, f.c.expression_id, mv.c.shot_id, mv.c.camera_id, f.c.path]).\
+        select_from(f.outerjoin(mv, mv.c.id == f.c.id)).order_by(f.c.client_id, f.c.session_id, f.c.recording_id, f.c.id)).fetchall()
+    files = numpy.array([[-1 if v is None else v for v in r[:7]] for r in rows], dtype=numpy.int64).reshape(-1, 7)
+    paths = [r[7].encode('ascii') for r in rows]
+    paths = numpy.array(paths, dtype=string_dtype(paths, 'S'))
+    # as in the SQL queries, which join the clients
+    selected = isin(files[:,1], self.m_client_id)
+    files, self.m_file_path = files[selected], paths[selected]
+    self.m_file_id, self.m_file_client_id, self.m_file_session_id, self.m_file_recording_id, self.m_file_expression_id, \
+        self.m_file_shot_id, self.m_file_camera_id = [files[:,k].copy() for k in range(7)]
+    # the first to fourth sessions of the client of each file
+    self.m_file_client_sessions = client_sessions[numpy.searchsorted(self.m_client_id, self.m_file_client_id)].T.copy()
+
+    # file id -> position in the file columns
+    position = numpy.full(int(self.m_file_id.max()) + 1 if len(self.m_file_id) else 1, -1, dtype=numpy.int64)
+    position[self.m_file_id] = numpy.arange(len(self.m_file_id))
+
+    # the sorted positions of the files of each protocol purpose
+    rows = session.execute(select([ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose]).\
+        select_from(ProtocolPurpose.__table__.join(Protocol.__table__)).order_by(ProtocolPurpose.id)).fetchall()
+    a = protocolPurpose_file_association
+    links = numpy.array(session.execute(select([a.c.protocolPurpose_id, a.c.file_id])).fetchall(), dtype=numpy.int64).reshape(-1, 2)
+    links = links[links[:,1] < len(position)]
+    links[:,1] = position[links[:,1]]
+    links = links[links[:,1] >= 0]
+    self.m_purpose_id = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+    self.m_purpose_protocol = _text(r[1] for r in rows)
+    self.m_purpose_sgroup = _text(r[2] for r in rows)
+    self.m_purpose_purpose = _text(r[3] for r in rows)
+    self.m_purpose_offsets, self.m_purpose_files = _pack([numpy.unique(links[links[:,0] == r[0], 1]) for r in rows])
+
+    # the clients of each subworld
+    names = [n for (n,) in session.execute(select([Subworld.name]).order_by(Subworld.id))]
+    members = dict((n, []) for n in names)
+    for name, client_id in session.execute(select([Subworld.name, subworld_client_association.c.client_id]).\
+        select_from(Subworld.__table__.join(subworld_client_association))):
+      members[name].append(client_id)
+    self.m_subworld_name = _text(names)
+    self.m_subworld_offsets, self.m_subworld_clients = _pack([members[n] for n in names])
+
+    # the names, in the order of their ids
+    self.m_protocol_name = _text(n for (n,) in session.execute(select([Protocol.name]).order_by(Protocol.id)))
+    rows = session.execute(select([Expression.id, Expression.name]).order_by(Expression.id)).fetchall()
+    self.m_expression_id, self.m_expression_name = numpy.array([r[0] for r in rows], dtype=numpy.int64), _text(r[1] for r in rows)
+    rows = session.execute(select([Camera.id, Camera.name]).order_by(Camera.id)).fetchall()
+    self.m_camera_id, self.m_camera_name = numpy.array([r[0] for r in rows], dtype=numpy.int64), _text(r[1] for r in rows)
+
+  def save(self, directory, fingerprint = None):
+    """Writes all arrays to .npy files in the given directory, together with
+       the fingerprint of the database (if given), see load()"""
+
+    import os
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    for name in self.ARRAYS:
+      numpy.save(os.path.join(directory, name + '.npy'), getattr(self, 'm_' + name))
+    with open(os.path.join(directory, 'fingerprint'), 'w') as f:
+      f.write('%s\n' % (fingerprint or ''))
+
+  @classmethod
+  def load(cls, directory, mmap = True):
+    """Reads the arrays written by save(), memory-mapping them read-only,
+       unless mmap is False. Returns the columns and the fingerprint of the
+       database they were exported from."""
+
+    import os
+    self = cls.__new__(cls)
+    for name in cls.ARRAYS:
+      setattr(self, 'm_' + name, numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None))
+    with open(os.path.join(directory, 'fingerprint')) as f:
+      fingerprint = f.read().strip()
+    return self, fingerprint
+
+  def names(self):
+    """Returns the names of the protocols, subworlds, expressions and cameras,
+       each in the order of their ids"""
+
+    return tuple(tuple(str(n) for n in a) for a in (self.m_protocol_name, self.m_subworld_name, self.m_expression_name, self.m_camera_name))
+
+  def ids(self):
+    """Returns the ids of the expressions and cameras by name and of the
+       protocol purposes by (protocol name, group, purpose), as dictionaries"""
+
+    return (dict((str(n), int(i)) for (n, i) in zip(self.m_expression_name, self.m_expression_id)),
+            dict((str(n), int(i)) for (n, i) in zip(self.m_camera_name, self.m_camera_id)),
+            dict(((str(p), str(g), str(u)), int(i)) for (p, g, u, i) in
+                zip(self.m_purpose_protocol, self.m_purpose_sgroup, self.m_purpose_purpose, self.m_purpose_id)))
+
+  def _purpose_files(self, protocols, groups, purpose = None):
+    """Returns the sorted positions of the files of the given protocols and
+       groups (and purpose, if given)"""
+    m = isin(self.m_purpose_protocol, list(protocols)) & isin(self.m_purpose_sgroup, list(groups))
+    if purpose is not None:
+      m &= self.m_purpose_purpose == purpose
+    o = self.m_purpose_offsets
+    selected = [self.m_purpose_files[o[k]:o[k+1]] for k in numpy.flatnonzero(m)]
+    return numpy.unique(numpy.concatenate(selected)) if selected else numpy.array([], dtype=numpy.int64)
+
+  def _subworld_clients(self, subworld):
+    o = self.m_subworld_offsets
+    selected = [self.m_subworld_clients[o[k]:o[k+1]] for k in numpy.flatnonzero(isin(self.m_subworld_name, list(subworld)))]
+    return numpy.concatenate(selected) if selected else numpy.array([], dtype=numpy.int64)
+
+  def object_ids(self, *args):
+    """Returns the ids of the files for the validated parameters of
+       Database.objects(), in the same order"""
+    return self.m_file_id[self.object_positions(*args)]
+
+  def object_positions(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras, world_sampling,
+      world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots):
+    """Returns the positions in the file columns of the files for the validated
+       parameters of Database.objects(), in the same order"""
+
+    expression_ids = self.m_expression_id[isin(self.m_expression_name, list(expressions))] if expressions else None
+    camera_ids = self.m_camera_id[isin(self.m_camera_name, list(cameras))] if cameras else None
+    model_ids = [int(m) for m in model_ids]
+
+    def common(r):
+      """The filters on expressions and cameras, which all branches share"""
+      m = numpy.ones(len(r), dtype=bool)
+      if expressions:
+        m &= isin(self.m_file_expression_id[r], expression_ids)
+      if cameras:
+        m &= isin(self.m_file_camera_id[r], camera_ids)
+      return m
+
+    branches = []
+    if 'world' in groups:
+      r = self._purpose_files(protocol, ('world',))
+      m = common(r)
+      if subworld:
+        m &= isin(self.m_file_client_id[r], self._subworld_clients(subworld))
+      shot = self.m_file_shot_id[r]
+      if cameras or world_nshots or world_shots or world_sampling != 1 or world_noflash:
+        # only multiview files
+        m &= shot >= 0
+      s, rec = self.m_file_session_id[r], self.m_file_recording_id[r]
+      first, second, third, fourth = self.m_file_client_sessions[:,r]
+      if world_nshots:
+        max1, max2, max3, max4 = world_nshots_limits(world_nshots)
+        m &= ((s == first) & (((rec == 1) & (shot < max1)) | ((rec == 2) & (shot < max2)))) | \
+             ((s == second) & (((rec == 1) & (shot < max2)) | ((rec == 2) & (shot < max3)))) | \
+             ((s == third) & (((rec == 1) & (shot < max3)) | ((rec == 2) & (shot < max4)))) | \
+             ((s == fourth) & (shot < max4))
+      if world_shots:
+        m &= isin(shot, list(world_shots))
+      if world_sampling != 1 and world_noflash == False:
+        m &= ((self.m_file_client_id[r] + shot) % world_sampling) == 0
+      if world_noflash:
+        m &= shot == 0
+      if world_first:
+        m &= (s == first) & ((first != 4) | ((first == 4) & (rec == 1)))
+      if world_second:
+        m &= ((second != 4) & (s == second)) | ((first == 4) & (s == 4) & (rec == 2)) | ((second == 4) & (s == 4) & (rec == 1))
+      if world_third:
+        m &= ((third != 4) & (s == third)) | ((second == 4) & (s == 4) & (rec == 2)) | ((third == 4) & (s == 4) & (rec == 1))
+      if world_fourth:
+        m &= ((fourth != 4) & (s == fourth)) | ((third == 4) & (s == 4) & (rec == 2)) | ((fourth == 4) & (s == 4) & (rec == 1))
+      if model_ids:
+        m &= isin(self.m_file_client_id[r], model_ids)
+      branches.append(r[m])
+
+    if 'dev' in groups or 'eval' in groups:
+      if 'enroll' in purposes:
+        r = self._purpose_files(protocol, groups, 'enroll')
+        m = common(r)
+        if model_ids:
+          m &= isin(self.m_file_client_id[r], model_ids)
+        branches.append(r[m])
+
+      if 'probe' in purposes:
+        r = self._purpose_files(protocol, groups, 'probe')
+        if 'client' in classes:
+          m = common(r)
+          if model_ids:
+            m &= isin(self.m_file_client_id[r], model_ids)
+          branches.append(r[m])
+        if 'impostor' in classes:
+          m = common(r)
+          if len(model_ids) == 1:
+            m &= ~isin(self.m_file_client_id[r], model_ids)
+          branches.append(r[m])
+
+    if not branches:
+      return numpy.array([], dtype=numpy.int64)
+    # the positions are sorted in the order of the results
+    return numpy.unique(numpy.concatenate(branches))
+
+  def file_array(self, positions):
+    """Returns the files at the given positions as a numpy structured array
+       with the fields of Database.objects_array()"""
+
+    paths = self.m_file_path[positions]
+    width = int(numpy.char.str_len(paths).max()) if len(paths) else 1
+    dtype = [('id', numpy.int32), ('client_id', numpy.int32), ('path', 'S%d' % width),
+             ('session_id', numpy.int8), ('recording_id', numpy.int8), ('shot_id', numpy.int8),
+             ('camera_id', numpy.int8), ('expression_id', numpy.int8)]
+    array = numpy.empty(len(positions), dtype=dtype)
+    for name, column in (('id', self.m_file_id), ('client_id', self.m_file_client_id), ('session_id', self.m_file_session_id),
+        ('recording_id', self.m_file_recording_id), ('shot_id', self.m_file_shot_id), ('camera_id', self.m_file_camera_id),
+        ('expression_id', self.m_file_expression_id)):
+      array[name] = column[positions]
+    array['path'] = paths
+    return array
+
+  def client_ids(self, groups, subworld, genders, birthyears):
+    """Returns the ids of the clients for the validated parameters of
+       Database.clients(), in the same order"""
+
+    if birthyears is None:
+      birthyear_mask = ((self.m_client_birthyear >= 1900) & (self.m_client_birthyear <= 2049)) | (self.m_client_birthyear == 57)
+    else:
+      birthyear_mask = isin(self.m_client_birthyear, list(birthyears))
+    m = isin(self.m_client_gender, list(genders)) & birthyear_mask
+
+    retval = []
+    if 'world' in groups:
+      world = m & (self.m_client_sgroup == 'world')
+      if subworld:
+        world &= isin(self.m_client_id, self._subworld_clients(subworld))
+      retval.append(self.m_client_id[world])
+    if 'dev' in groups or 'eval' in groups:
+      retval.append(self.m_client_id[m & (self.m_client_sgroup != 'world') & isin(self.m_client_sgroup, list(groups))])
+    return numpy.concatenate(retval) if retval else numpy.array([], dtype=numpy.int64)
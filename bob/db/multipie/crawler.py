@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Laurent El Shafey <Laurent.El-Shafey@idiap.ch>
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Crawls the image directory tree of the Multi-PIE database.
+"""
+
+import os
+import gzip
+import hashlib
+import collections
+
+from .cache import atomic_file
+
+try:
+  from os import scandir
+except ImportError:
+  # python < 3.5
+  scandir = None
+
+MANIFEST_HEADER = '# bob.db.multipie manifest'
+
+FileRecord = collections.namedtuple('FileRecord', ('path', 'img_type', 'session_id', 'client_id', 'recording_id', 'camera_name', 'shot_id'))
+"""A parsed image of the database; camera_name and shot_id are None for highres images."""
+
+def nodot(item):
+  """Can be used to ignore hidden files, starting with the . character."""
+  return item[0] != '.'
+
+def listdir(path):
+  """Returns the names of the non-hidden entries of the given directory."""
+  if scandir is None:
+    return list(filter(nodot, os.listdir(path)))
+  return [e.name for e in scandir(path) if nodot(e.name)]
+
+def parse_path(path):
+  """Parses the relative path (without extension) of an image, e.g.,
+     'session02/multiview/108/01/05_1/108_02_01_051_17', into a FileRecord."""
+  v = path.split('_')
+  d = path.split(os.sep)
+  session_id = int(d[0][8])
+  client_id = int(d[2])
+  if d[1] == 'multiview':
+    return FileRecord(path, 'multiview', session_id, client_id, int(d[3]), d[4], int(v[5]))
+  else:
+    return FileRecord(path, 'highres', session_id, client_id, int(v[1]), None, None)
+
+def _crawl_multiview(task):
+  """Lists and parses the multiview images of a single session/client directory."""
+  imagedir, session_id, client_id, poses = task
+  records = []
+  client_dir = os.path.join(imagedir, session_id, 'multiview', client_id)
+  # recording id
+  for recording_id in listdir(client_dir):
+    recording_dir = os.path.join(client_dir, recording_id)
+    # camera name
+    for camera_name in listdir(recording_dir):
+      # Check if it is the frontal camera 05_1
+      if ((not poses) and camera_name != '05_1'):
+        continue
+      camera_dir = os.path.join(recording_dir, camera_name)
+      # flashes/images
+      for filename in listdir(camera_dir):
+        basename, extension = os.path.splitext(filename)
+        records.append(parse_path(os.path.join(session_id, 'multiview', client_id, recording_id, camera_name, basename)))
+  return records
+
+def _crawl_highres(task):
+  """Lists and parses the highres images of a single session/client directory."""
+  imagedir, session_id, client_id = task
+  client_dir = os.path.join(imagedir, session_id, 'highres', client_id)
+  # flashes/images
+  return [parse_path(os.path.join(session_id, 'highres', client_id, os.path.splitext(filename)[0])) for filename in listdir(client_dir)]
+
+def _crawl_task(task):
+  if task[0] == 'multiview':
+    return _crawl_multiview(task[1:])
+  return _crawl_highres(task[1:])
+
+def crawl(imagedir, poses=True, highresolutions=True, threads=1, jobs=1):
+  """Walks the image directory tree of the Multi-PIE database and yields one
+  FileRecord per image.
+
+  Keyword Parameters:
+
+  imagedir
+    The directory containing the session directories of the database
+
+  poses
+    If False, only the frontal camera '05_1' is crawled
+
+  highresolutions
+    If False, the 'highres' directories are not crawled
+
+  threads
+    The number of threads listing the session/client directories in parallel.
+    Records are yielded in the same order as with a single thread.
+
+  jobs
+    The number of processes listing and parsing the session/client directories
+    in parallel; each of them sends back the records of one directory at a
+    time. If greater than 1, threads is ignored. Records are yielded in the
+    same order as with a single process.
+  """
+
+  def tasks():
+    # session
+    for session_id in listdir(imagedir):
+      se_dir = os.path.join(imagedir, session_id)
+      # multiview client id
+      for client_id in listdir(os.path.join(se_dir, 'multiview')):
+        yield ('multiview', imagedir, session_id, client_id, poses)
+      if highresolutions:
+        # highres client id
+        for client_id in listdir(os.path.join(se_dir, 'highres')):
+          yield ('highres', imagedir, session_id, client_id)
+
+  if jobs > 1 or threads > 1:
+    if jobs > 1:
+      from multiprocessing import Pool
+      pool = Pool(jobs)
+    else:
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(threads)
+    try:
+      for records in pool.imap(_crawl_task, tasks()):
+        for record in records:
+          yield record
+    finally:
+      pool.terminate()
+  else:
+    for task in tasks():
+      for record in _crawl_task(task):
+        yield record
+
+def tree_checksum(imagedir):
+  """Computes a checksum of the root listing of the image tree, i.e., of the
+  names of the session directories, their image type directories and the
+  client directories contained therein."""
+
+  h = hashlib.sha1()
+  for session_id in sorted(listdir(imagedir)):
+    se_dir = os.path.join(imagedir, session_id)
+    h.update(session_id.encode('utf-8') + b'\n')
+    for img_type in sorted(listdir(se_dir)):
+      h.update(os.path.join(session_id, img_type).encode('utf-8') + b'\n')
+      for client_id in sorted(listdir(os.path.join(se_dir, img_type))):
+        h.update(os.path.join(session_id, img_type, client_id).encode('utf-8') + b'\n')
+  return h.hexdigest()
+
+def write_manifest(filename, records, checksum):
+  """Writes the paths of the given records to a gzip compressed manifest file,
+  while passing the records through.
+
+  The manifest is written to a temporary file of its own (see
+  cache.atomic_file()), which is moved to the given file name only after all
+  records have been consumed.
+  """
+
+  with atomic_file(filename) as tmpname:
+    f = gzip.open(tmpname, 'wb')
+    try:
+      f.write(('%s %s\n' % (MANIFEST_HEADER, checksum)).encode('utf-8'))
+      for record in records:
+        f.write(record.path.encode('utf-8') + b'\n')
+        yield record
+    finally:
+      f.close()
+
+def read_manifest(filename):
+  """Reads a manifest file written by write_manifest().
+
+  Returns the checksum of the image tree that was stored in the manifest, and
+  a generator of the FileRecords listed in it.
+  """
+
+  f = gzip.open(filename, 'rb')
+  header = f.readline().decode('utf-8').split()
+  if ' '.join(header[:-1]) != MANIFEST_HEADER:
+    f.close()
+    raise IOError("The file '%s' is not a Multi-PIE manifest" % filename)
+
+  def records():
+    try:
+      for line in f:
+        yield parse_path(line.decode('utf-8').rstrip('\n'))
+    finally:
+      f.close()
+
+  return header[-1], records()
@@ -21,12 +21,12 @@
 
 import os
 import fileinput
+from sqlalchemy import literal
 
 from .models import *
-
-def nodot(item):
-  """Can be used to ignore hidden files, starting with the . character."""
-  return item[0] != '.'
+from .crawler import crawl, tree_checksum, read_manifest, write_manifest
+from .profiling import Profiler
+from .cache import atomic_write
 
 def add_clients(session, filelist, verbose):
   """Add files (and clients) to the Multi-PIE database."""
@@ -86,170 +86,210 @@ def add_clients(session, filelist, verbose):
       first_session = 4
     #TODO: if first_session == 0: raises an error
 
-    if not (v[0] in client_dict):
+    if not (int(v[0]) in client_dict):
       group = 'world'
       if int(v[0]) in dev_ids: group = 'dev'
       elif int(v[0]) in eval_ids: group = 'eval'
       if verbose>1: print("Adding client '%d' ..." % int(v[0]))
       session.add(Client(int(v[0]), group, int(v[1]), v[2], first_session, second_session, third_session, fourth_session))
-      client_dict[v[0]] = True
+      client_dict[int(v[0])] = True
 
-  client_dict = {}
+  # clients that are already in the database are kept
+  client_dict = dict((c_id, True) for (c_id,) in session.query(Client.id))
   for line in fileinput.input(filelist):
     add_client(session, line, client_dict, verbose)
 
-def add_subworlds(session, verbose):
+# Splits of the world set, as (name, client ids) pairs
+SUBWORLDS = (
+  ('sub41', [ 21,  26,  31,  39,  66,  75,  81,  90,  98, 109, 114, 148, 152, 158, 165, 171, 174, 179, 182, 197,
+             207, 215, 226, 239, 244, 256, 271, 277, 303, 309, 310, 315, 321, 326, 327, 333, 336, 338, 339, 341,
+             342]),
+  ('sub81', [ 16,  21,  26,  31,  37,  39,  51,  65,  66,  73,  75,  81,  84,  86,  87,  90,  94,  95,  98,  99,
+             109, 114, 134, 142, 144, 148, 151, 152, 158, 164, 165, 171, 173, 174, 179, 182, 195, 197, 207, 215,
+             217, 222, 226, 239, 244, 247, 249, 251, 256, 259, 260, 263, 264, 265, 271, 272, 276, 277, 287, 298,
+             303, 304, 306, 309, 310, 312, 315, 317, 319, 320, 321, 324, 326, 327, 329, 333, 336, 338, 339, 341,
+             342]),
+  ('sub121', [  7,  16,  21,  24,  26,  30,  31,  37,  39,  51,  60,  61,  63,  65,  66,  72,  73,  75,  81,  84,
+               86,  87,  90,  91,  94,  95,  96,  98,  99, 109, 114, 134, 135, 142, 144, 148, 151, 152, 158, 159,
+              164, 165, 166, 171, 173, 174, 176, 179, 180, 182, 195, 197, 207, 210, 214, 215, 217, 221, 222, 226,
+              228, 231, 233, 234, 239, 242, 244, 247, 249, 251, 253, 254, 255, 256, 259, 260, 263, 264, 265, 268,
+              271, 272, 276, 277, 278, 279, 285, 287, 291, 292, 293, 294, 297, 298, 300, 301, 303, 304, 306, 309,
+              310, 311, 312, 315, 317, 319, 320, 321, 322, 324, 325, 326, 327, 329, 333, 336, 338, 339, 341, 342,
+              344]),
+  ('sub161', [  7,  12,  13,  16,  21,  24,  26,  30,  31,  37,  39,  45,  51,  60,  61,  63,  65,  66,  72,  73,
+               75,  77,  81,  82,  84,  86,  87,  88,  90,  91,  93,  94,  95,  96,  98,  99, 101, 109, 114, 119,
+              120, 121, 134, 135, 136, 142, 144, 148, 151, 152, 153, 158, 159, 160, 162, 163, 164, 165, 166, 171,
+              173, 174, 176, 179, 180, 182, 187, 195, 197, 200, 207, 210, 214, 215, 216, 217, 218, 219, 221, 222,
+              226, 228, 229, 231, 233, 234, 237, 239, 242, 244, 247, 249, 251, 253, 254, 255, 256, 257, 259, 260,
+              261, 263, 264, 265, 267, 268, 271, 272, 273, 276, 277, 278, 279, 285, 287, 289, 291, 292, 293, 294,
+              295, 296, 297, 298, 299, 300, 301, 303, 304, 306, 308, 309, 310, 311, 312, 313, 314, 315, 317, 319,
+              320, 321, 322, 323, 324, 325, 326, 327, 329, 333, 335, 336, 337, 338, 339, 341, 342, 343, 344, 345,
+              346]),
+)
+
+def read_subworlds(filename):
+  """Reads additional splits of the world set from the given text file.
+
+  Each line contains the name of a subworld followed by the ids of its
+  clients, all separated by white spaces, e.g., 'sub200 7 12 13 ...'. Empty
+  lines and everything after a '#' character are ignored.
+  """
+
+  subworlds = []
+  names = set()
+  for line in open(filename):
+    fields = line.split('#')[0].split()
+    if not fields:
+      continue
+    if fields[0] in names:
+      raise ValueError("The subworld '%s' is defined twice in '%s'" % (fields[0], filename))
+    names.add(fields[0])
+    subworlds.append((fields[0], [int(c_id) for c_id in fields[1:]]))
+  return subworlds
+
+def add_subworlds(session, verbose, subworlds = SUBWORLDS):
   """Adds splits in the world set, based on the client ids"""
 
-  # Lists for the subworld subsets
-  l41 =  [ 21,  26,  31,  39,  66,  75,  81,  90,  98, 109, 114, 148, 152, 158, 165, 171, 174, 179, 182, 197,
-          207, 215, 226, 239, 244, 256, 271, 277, 303, 309, 310, 315, 321, 326, 327, 333, 336, 338, 339, 341,
-          342]
-  l81 =  [ 16,  21,  26,  31,  37,  39,  51,  65,  66,  73,  75,  81,  84,  86,  87,  90,  94,  95,  98,  99,
-          109, 114, 134, 142, 144, 148, 151, 152, 158, 164, 165, 171, 173, 174, 179, 182, 195, 197, 207, 215,
-          217, 222, 226, 239, 244, 247, 249, 251, 256, 259, 260, 263, 264, 265, 271, 272, 276, 277, 287, 298,
-          303, 304, 306, 309, 310, 312, 315, 317, 319, 320, 321, 324, 326, 327, 329, 333, 336, 338, 339, 341,
-          342]
-  l121 = [  7,  16,  21,  24,  26,  30,  31,  37,  39,  51,  60,  61,  63,  65,  66,  72,  73,  75,  81,  84,
-           86,  87,  90,  91,  94,  95,  96,  98,  99, 109, 114, 134, 135, 142, 144, 148, 151, 152, 158, 159,
-          164, 165, 166, 171, 173, 174, 176, 179, 180, 182, 195, 197, 207, 210, 214, 215, 217, 221, 222, 226,
-          228, 231, 233, 234, 239, 242, 244, 247, 249, 251, 253, 254, 255, 256, 259, 260, 263, 264, 265, 268,
-          271, 272, 276, 277, 278, 279, 285, 287, 291, 292, 293, 294, 297, 298, 300, 301, 303, 304, 306, 309,
-          310, 311, 312, 315, 317, 319, 320, 321, 322, 324, 325, 326, 327, 329, 333, 336, 338, 339, 341, 342,
-          344]
-  l161 = [  7,  12,  13,  16,  21,  24,  26,  30,  31,  37,  39,  45,  51,  60,  61,  63,  65,  66,  72,  73,
-           75,  77,  81,  82,  84,  86,  87,  88,  90,  91,  93,  94,  95,  96,  98,  99, 101, 109, 114, 119,
-          120, 121, 134, 135, 136, 142, 144, 148, 151, 152, 153, 158, 159, 160, 162, 163, 164, 165, 166, 171,
-          173, 174, 176, 179, 180, 182, 187, 195, 197, 200, 207, 210, 214, 215, 216, 217, 218, 219, 221, 222,
-          226, 228, 229, 231, 233, 234, 237, 239, 242, 244, 247, 249, 251, 253, 254, 255, 256, 257, 259, 260,
-          261, 263, 264, 265, 267, 268, 271, 272, 273, 276, 277, 278, 279, 285, 287, 289, 291, 292, 293, 294,
-          295, 296, 297, 298, 299, 300, 301, 303, 304, 306, 308, 309, 310, 311, 312, 313, 314, 315, 317, 319,
-          320, 321, 322, 323, 324, 325, 326, 327, 329, 333, 335, 336, 337, 338, 339, 341, 342, 343, 344, 345,
-          346]
-  snames = ['sub41', 'sub81', 'sub121', 'sub161']
-  slist = [l41, l81, l121, l161]
-  for k in range(len(snames)):
-    if verbose: print("Adding subworld '%s'" %(snames[k], ))
-    su = Subworld(snames[k])
+  from sqlalchemy import select
+  existing = set(name for (name,) in session.query(Subworld.name))
+  for name, client_ids in subworlds:
+    if name in existing:
+      continue
+    if verbose: print("Adding subworld '%s'" %(name, ))
+    su = Subworld(name)
     session.add(su)
     session.flush()
-    session.refresh(su)
-    l = slist[k]
-    for c_id in l:
-      if verbose>1: print("Adding client '%d' to subworld '%s'..." %(c_id, snames[k]))
-      su.clients.append(session.query(Client).filter(Client.id == c_id).first())
-
-def add_files(session, imagedir, illuminations, poses, expressions, highresolutions, verbose):
-  """Add files (and clients) to the Multi-PIE database."""
-
-  def add_mv_file(session, filename, session_id, client_id, recording_id, camera_name, expr_dict, cam_dict, expressions, verbose):
-    """Parse a single filename and add it to the list.
-       Also add a client entry if not already in the database."""
-    v = os.path.splitext(filename)[0].split('_')
-    shot_id = int(v[5])
-    if illuminations or shot_id == 0:
-      if verbose>1: print("Adding file (multiview) '%s' ..." %(filename,))
-      sid = int(session_id[8])
-      rid = int(recording_id)
-      eid = expr_dict[(sid,rid)][0]
-      ename = expr_dict[(sid,rid)][1]
-      cid = cam_dict[camera_name]
-      if (expressions == True or ename == 'neutral'):
-        f = File(int(client_id), filename, sid, rid, 'multiview', eid)
-        # We want to make use of the new assigned file id
-        # We need to do the following:
-        session.add(f)
-        session.flush()
-        session.refresh(f)
-        session.add(FileMultiview(f.id, shot_id, cid))
-
-  def add_hr_file(session, filename, session_id, client_id, expr_dict, expressions, verbose):
-    """Parse a single filename and add it to the list.
-       Also add a client entry if not already in the database."""
-    if verbose>1: print("Adding file (highres) '%s' ..." %(filename,))
-    v = os.path.splitext(filename)[0].split('_')
-    sid = int(session_id[8])
-    rid = int(v[1])
-    eid = expr_dict[(sid,rid)][0]
-    ename = expr_dict[(sid,rid)][1]
+    # a single INSERT ... SELECT for all clients of the subworld
+    q = select([literal(su.id), Client.id]).where(Client.id.in_(client_ids)).order_by(Client.id)
+    r = session.execute(subworld_client_association.insert().from_select(['subworld_id', 'client_id'], q))
+    if verbose>1: print("Added %d clients to subworld '%s'" %(r.rowcount, name))
+    if verbose and r.rowcount != len(set(client_ids)):
+      print("Warning: %d client(s) of subworld '%s' are not in the database" %(len(set(client_ids)) - r.rowcount, name))
+
+class FileInserter(object):
+  """Collects the rows of the ``file`` and ``fileMultiview`` tables and writes
+     them in batches with executemany-style inserts.
+
+     The file ids are handed out here, starting after the largest id already
+     stored, so that no round trip to the database is needed to learn them."""
+
+  def __init__(self, session, batch_size = 10000):
+    from sqlalchemy import func
+    self.m_session = session
+    self.m_batch_size = batch_size
+    self.m_next_id = (session.query(func.max(File.id)).scalar() or 0) + 1
+    self.m_files = []
+    self.m_multiviews = []
+
+  def add(self, client_id, path, session_id, recording_id, img_type, expression_id, shot_id = None, camera_id = None):
+    """Queues a single file and returns the id that has been assigned to it."""
+    file_id = self.m_next_id
+    self.m_next_id += 1
+    self.m_files.append({'id': file_id, 'client_id': client_id, 'path': path, 'session_id': session_id,
+                         'recording_id': recording_id, 'img_type': img_type, 'expression_id': expression_id})
+    if img_type == 'multiview':
+      self.m_multiviews.append({'id': file_id, 'shot_id': shot_id, 'camera_id': camera_id})
+    if len(self.m_files) >= self.m_batch_size:
+      self.flush()
+    return file_id
+
+  def flush(self):
+    """Writes all queued rows to the database."""
+    if self.m_files:
+      self.m_session.execute(File.__table__.insert(), self.m_files)
+      self.m_files = []
+    if self.m_multiviews:
+      self.m_session.execute(FileMultiview.__table__.insert(), self.m_multiviews)
+      self.m_multiviews = []
+
+def add_files(session, records, illuminations, poses, expressions, highresolutions, verbose, progress=None):
+  """Add files (and clients) to the Multi-PIE database.
+     The files are given as an iterable of crawler.FileRecord's; files that are
+     already in the database are skipped.
+     If given, progress is called with the number of files added so far after each file.
+     Returns the id of the first newly added file, or None if no file was added."""
+
+  def add_file(inserter, record, expr_dict, cam_dict, verbose):
+    """Adds a single parsed file to the list, if it passes the filters."""
+    if record.path in known_paths:
+      return
+    if record.img_type == 'multiview':
+      if not (poses or record.camera_name == '05_1'):
+        return
+      if not (illuminations or record.shot_id == 0):
+        return
+    elif not highresolutions:
+      return
+    eid = expr_dict[(record.session_id, record.recording_id)][0]
+    ename = expr_dict[(record.session_id, record.recording_id)][1]
     if (expressions == True or ename == 'neutral'):
-      session.add(File(int(client_id), filename, sid, rid, 'highres', eid))
+      if verbose>2: print("Adding file (%s) '%s' ..." %(record.img_type, record.path))
+      if record.img_type == 'multiview':
+        inserter.add(record.client_id, record.path, record.session_id, record.recording_id, 'multiview', eid, record.shot_id, cam_dict[record.camera_name])
+      else:
+        inserter.add(record.client_id, record.path, record.session_id, record.recording_id, 'highres', eid)
 
   def add_expressions(session, verbose):
-    """Adds expressions"""
+    """Adds expressions (if not already in the database)"""
 
     expr_list = ['neutral', 'smile', 'surprise', 'squint', 'disgust', 'scream']
     expr_srid = [[(1,1), (2,1), (3,1), (4,1), (4,2)], [(1,2), (3,2)], [(2,2)], [(2,3)], [(3,3)], [(4,3)]]
     expr_dict = {}
     for k in range(len(expr_list)):
       el = expr_list[k]
-      if verbose: print("Adding expression '%s'..." % (el))
-      e = Expression(el)
-      session.add(e)
-      session.flush()
-      session.refresh(e)
+      e = session.query(Expression).filter(Expression.name == el).first()
+      if e is None:
+        if verbose: print("Adding expression '%s'..." % (el))
+        e = Expression(el)
+        session.add(e)
+        session.flush()
+        session.refresh(e)
       indices = expr_srid[k]
       for ind in indices:
         expr_dict[ind] = [e.id, e.name]
     return expr_dict
 
   def add_cameras(session, verbose):
-    """Adds cameras"""
+    """Adds cameras (if not already in the database)"""
 
     cam_list = ['24_0', '01_0', '20_0', '19_0', '04_1', '19_1', '05_0', '05_1', '14_0', '08_1',
                 '13_0', '08_0', '09_0', '12_0', '11_0']
     cam_dict = {}
     for el in cam_list:
-      if verbose: print("Adding cameras '%s'..." % (el))
-      c = Camera(el)
-      session.add(c)
-      session.flush()
-      session.refresh(c)
+      c = session.query(Camera).filter(Camera.name == el).first()
+      if c is None:
+        if verbose: print("Adding cameras '%s'..." % (el))
+        c = Camera(el)
+        session.add(c)
+        session.flush()
+        session.refresh(c)
       cam_dict[el] = c.id
     return cam_dict
 
   # Start by creating the expressions and the cameras
   expr_dict = add_expressions(session, verbose)
   cam_dict = add_cameras(session, verbose)
-
-  # session
-  for session_id in filter(nodot, os.listdir(imagedir)):
-    if verbose: print("Adding files for session '%s'..." % (session_id))
-    se_dir = os.path.join(imagedir, session_id)
-
-    # multiview
-    mv_dir = os.path.join(se_dir, 'multiview')
-    # client id
-    for client_id in filter(nodot, os.listdir(mv_dir)):
-      client_dir = os.path.join(mv_dir, client_id)
-      # recording id
-      for recording_id in filter(nodot, os.listdir(client_dir)):
-        recording_dir = os.path.join(client_dir, recording_id)
-        # camera name
-        for camera_name in filter(nodot, os.listdir(recording_dir)):
-          # Check if it is the frontal camera 05_1
-          if ((not poses) and camera_name != '05_1'):
-            continue
-          camera_dir = os.path.join(recording_dir, camera_name)
-          # flashes/images
-          for filename in filter(nodot, os.listdir(camera_dir)):
-            basename, extension = os.path.splitext(filename)
-            add_mv_file(session, os.path.join( session_id, 'multiview', client_id, recording_id, camera_name, basename), session_id, client_id,
-                        recording_id, camera_name, expr_dict, cam_dict, expressions, verbose)
-
-    if highresolutions:
-      # highres
-      hr_dir = os.path.join(se_dir, 'highres')
-      # client id
-      for client_id in filter(nodot, os.listdir(hr_dir)):
-        client_dir = os.path.join(hr_dir, client_id)
-        # flashes/images
-        for filename in filter(nodot, os.listdir(client_dir)):
-          basename, extension = os.path.splitext(filename)
-          add_hr_file(session, os.path.join( session_id, 'highres', client_id, basename), session_id, client_id, expr_dict, expressions, verbose)
-
-def add_protocols(session, illuminations, poses, expressions, highresolutions, verbose):
-  """Adds protocols"""
+  known_paths = set(path for (path,) in session.query(File.path))
+  inserter = FileInserter(session)
+  first_file_id = inserter.m_next_id
+
+  current_session = None
+  for record in records:
+    if verbose and record.session_id != current_session:
+      current_session = record.session_id
+      print("Adding files for session '%s'..." % (record.path.split(os.sep)[0]))
+    add_file(inserter, record, expr_dict, cam_dict, verbose)
+    if progress is not None: progress(inserter.m_next_id - first_file_id)
+
+  inserter.flush()
+  if inserter.m_next_id == first_file_id:
+    return None
+  return first_file_id
+
+def add_protocols(session, illuminations, poses, expressions, highresolutions, verbose, first_file_id=None):
+  """Adds protocols.
+     Protocols that are already in the database are only extended by the files
+     with ids starting at first_file_id (if given)."""
 
   # 1. DEFINITIONS
   # Tuples in the lists correspond to (session_ids, recording_ids, cameras, shot_ids),
@@ -353,21 +393,32 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
   # 2. ADDITIONS TO THE SQL DATABASE
   protocolPurpose_list = [('world', 'train'), ('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
   for proto in protocol_definitions:
-    p = Protocol(proto)
-    # Add protocol
-    if verbose: print("Adding protocol %s..." % (proto))
-    session.add(p)
-    session.flush()
-    session.refresh(p)
+    p = session.query(Protocol).filter(Protocol.name == proto).first()
+    # Existing protocols only need the newly added files
+    min_file_id = None
+    if p is not None:
+      if first_file_id is None:
+        continue
+      if verbose: print("Extending protocol %s..." % (proto))
+      min_file_id = first_file_id
+    else:
+      p = Protocol(proto)
+      # Add protocol
+      if verbose: print("Adding protocol %s..." % (proto))
+      session.add(p)
+      session.flush()
+      session.refresh(p)
 
     # Add protocol purposes
     for key in range(len(protocolPurpose_list)):
       purpose = protocolPurpose_list[key]
-      pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
-      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
-      session.add(pu)
-      session.flush()
-      session.refresh(pu)
+      pu = session.query(ProtocolPurpose).filter(and_(ProtocolPurpose.protocol_id == p.id, ProtocolPurpose.sgroup == purpose[0], ProtocolPurpose.purpose == purpose[1])).first()
+      if pu is None:
+        pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
+        if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
+        session.add(pu)
+        session.flush()
+        session.refresh(pu)
 
        # Add files attached with this protocol purpose
       client_group = ""
@@ -382,13 +433,13 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
       elif(key == 2 or key == 4):
         prop_list = protocol_definitions[proto][2]
 
-      # Adds 'protocol' files
+      # Adds 'protocol' files, with one INSERT ... SELECT statement per definition tuple
       for el in prop_list:
         sids = el[0] # list of session_ids
         rids = el[1] # list of recording_ids
         cams = el[2] # list of camera_ids
         shot_ids = el[3] # list of shot_ids
-        q = session.query(File).join(Client).join(FileMultiview).\
+        q = session.query(literal(pu.id), File.id).select_from(File).join(Client).join(FileMultiview).\
               filter(Client.sgroup == client_group)
         if sids:
           q = q.filter(File.session_id.in_(sids))
@@ -398,10 +449,71 @@ def add_protocols(session, illuminations, poses, expressions, highresolutions, v
           q = q.join(Camera).filter(Camera.name.in_(cams))
         if shot_ids:
           q = q.filter(FileMultiview.shot_id.in_(shot_ids))
+        if min_file_id is not None:
+          q = q.filter(File.id >= min_file_id)
         q = q.order_by(File.id)
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
+        r = session.execute(protocolPurpose_file_association.insert().from_select(['protocolPurpose_id', 'file_id'], q.statement))
+        if verbose>1: print("    Added %d protocol files" % (r.rowcount,))
+
+def add_ordinals(session, verbose):
+  """Sets the derived columns File.session_ordinal and File.shot_ordinal of
+     all files with two UPDATE statements, adding the columns first to
+     databases that were created before they were declared"""
+
+  from sqlalchemy import select, case, and_, or_
+
+  existing = set(row[1] for row in session.execute("PRAGMA table_info(file)"))
+  for column in ('session_ordinal', 'shot_ordinal'):
+    if column not in existing:
+      if verbose: print("Adding column '%s'..." % column)
+      session.execute("ALTER TABLE file ADD COLUMN %s INTEGER" % column)
+
+  if verbose: print("Computing the session and shot ordinals of the files...")
+  f, c, mv = File.__table__, Client.__table__, FileMultiview.__table__
+  sessions = (c.c.first_session, c.c.second_session, c.c.third_session, c.c.fourth_session)
+
+  # the recordings of session 4 count as separate sessions, see Database.objects()
+  whens = [(and_(f.c.session_id == sessions[0], or_(sessions[0] != 4, f.c.recording_id == 1)), 1)]
+  for k in range(1, 4):
+    whens.append((or_(and_(sessions[k] != 4, f.c.session_id == sessions[k]),
+                      and_(sessions[k-1] == 4, f.c.session_id == 4, f.c.recording_id == 2),
+                      and_(sessions[k] == 4, f.c.session_id == 4, f.c.recording_id == 1)), k + 1))
+  ordinal = select([case(whens)]).where(c.c.id == f.c.client_id).as_scalar()
+  session.execute(f.update().values(session_ordinal=ordinal))
+
+  # the first recording of each session continues the shots of the previous
+  # recording, with 19 shots each; all recordings of the fourth session share
+  # the last block
+  whens = []
+  for k in range(3):
+    for recording in (1, 2):
+      start = 19 * (k + recording - 1)
+      condition = and_(f.c.session_id == sessions[k], f.c.recording_id == recording)
+      if start < 57:
+        condition = and_(condition, mv.c.shot_id < 19)
+      whens.append((condition, start + mv.c.shot_id))
+  whens.append((f.c.session_id == sessions[3], 57 + mv.c.shot_id))
+  ordinal = select([case(whens)]).where(and_(c.c.id == f.c.client_id, mv.c.id == f.c.id)).as_scalar()
+  session.execute(f.update().values(shot_ordinal=ordinal))
+
+def file_records(args):
+  """Returns the FileRecord's of the images, either read from the manifest or
+     crawled from the image directory."""
+
+  manifest = args.manifest
+  if manifest and os.path.exists(manifest):
+    checksum, records = read_manifest(manifest)
+    if not args.check_manifest or checksum == tree_checksum(args.imagedir):
+      if args.verbose: print("Reading files from manifest '%s' (checksum %s)..." % (manifest, checksum))
+      return records
+    if args.verbose: print("The manifest '%s' is outdated; crawling '%s' again..." % (manifest, args.imagedir))
+
+  if manifest:
+    # crawl the whole tree, so that the manifest can serve all kinds of databases
+    if args.verbose: print("Writing manifest '%s'..." % (manifest,))
+    return write_manifest(manifest, crawl(args.imagedir, threads=args.threads, jobs=args.jobs), tree_checksum(args.imagedir))
+
+  return crawl(args.imagedir, args.poses, args.highresolutions, args.threads, args.jobs)
 
 def create_tables(args):
   """Creates all necessary tables (only to be used at the first time)"""
@@ -411,46 +523,223 @@ def create_tables(args):
   engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
   Base.metadata.create_all(engine)
 
+def raw_connection(session):
+  """Returns the sqlite3 connection underlying the given session"""
+  return session.connection().connection.connection
+
+def copy_database(source, target):
+  """Copies the complete content of the sqlite3 connection source into target"""
+  if hasattr(source, 'backup'):
+    source.backup(target)
+  else:
+    # python < 3.7 has no access to the SQLite backup API
+    target.executescript('\n'.join(source.iterdump()))
+    target.commit()
+
+def create_indexes(session, verbose):
+  """Creates the indexes of the schema that are missing, e.g., in databases
+     that were created before the indexes were declared"""
+
+  existing = set(name for (name,) in session.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+  for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+      if index.name not in existing:
+        if verbose: print("Creating index '%s'..." % index.name)
+        index.create(session.connection())
+
+def optimize(connection, verbose):
+  """Collects the statistics for the query planner, picks the page size and
+     compacts the database of the given sqlite3 connection"""
+
+  page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+  page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+  # larger pages mean fewer reads for the index scans of big databases
+  new_page_size = 4096 if page_count * page_size < 64 * 1024 * 1024 else 8192
+  if verbose: print("Analyzing and vacuuming the database (page size %d)..." % new_page_size)
+  connection.execute('ANALYZE')
+  connection.execute('PRAGMA page_size = %d' % new_page_size)
+  connection.execute('VACUUM')
+
+def memory_session(args):
+  """Returns a session to an in-memory database with relaxed durability.
+     When updating, the database starts with the content of the database file."""
+
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+  from sqlalchemy.pool import StaticPool
+  import sqlite3
+
+  # a single connection, since every connection would see another in-memory database
+  engine = create_engine('sqlite://', echo=(args.verbose >= 2), poolclass=StaticPool, connect_args={'check_same_thread': False})
+  s = sessionmaker(bind=engine)()
+  connection = raw_connection(s)
+  if args.update and os.path.exists(args.files[0]):
+    if args.verbose: print("Loading '%s' into memory..." % args.files[0])
+    source = sqlite3.connect(args.files[0])
+    copy_database(source, connection)
+    source.close()
+  connection.execute('PRAGMA journal_mode = OFF')
+  connection.execute('PRAGMA synchronous = OFF')
+  Base.metadata.create_all(engine)
+  return s
+
+def save_database(session, dbfile, verbose, optimized=True):
+  """Writes the in-memory database of the given session to a temporary file,
+     which is then renamed to dbfile, so that readers never see a partial database."""
+
+  import sqlite3
+
+  def write(tmpname):
+    target = sqlite3.connect(tmpname)
+    copy_database(raw_connection(session), target)
+    if optimized:
+      optimize(target, verbose)
+    target.close()
+
+  if verbose: print("Writing database to '%s'..." % dbfile)
+  atomic_write(dbfile, write)
+
 # Driver API
 # ==========
 
-def create(args):
-  """Creates or re-creates this database"""
+def variant(spec):
+  """Parses a database variant given as OUTPUT[:FLAGS], where FLAGS combines
+     the letters I, P, E and H of the options of the same names"""
+
+  import argparse
+  output, flags = spec, ''
+  if ':' in spec and set(spec.rsplit(':', 1)[1]) <= set('IPEH'):
+    output, flags = spec.rsplit(':', 1)
+  if not output:
+    raise argparse.ArgumentTypeError("The variant '%s' has no output file" % spec)
+  return (os.path.abspath(output), flags)
+
+def count_rows(session, table):
+  """Returns the number of rows of the given table"""
+  from sqlalchemy import select, func
+  return session.execute(select([func.count()]).select_from(table)).scalar()
+
+def build_database(args, records, profiler):
+  """Creates the database args.files[0] with the given FileRecord's"""
 
   from bob.db.base.utils import session_try_nolock
 
   dbfile = args.files[0]
 
-  if args.recreate:
+  if args.recreate and not args.in_memory:
     if args.verbose and os.path.exists(dbfile):
       print('unlinking %s...' % dbfile)
     if os.path.exists(dbfile): os.unlink(dbfile)
+  elif os.path.exists(dbfile) and not (args.recreate or args.update):
+    raise IOError("The database file '%s' already exists; use --recreate to build it from scratch or --update to add the missing parts" % dbfile)
 
   if not os.path.exists(os.path.dirname(dbfile)):
     os.makedirs(os.path.dirname(dbfile))
 
   # the real work...
-  create_tables(args)
-  s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
-  add_clients(s, args.subjectlist, args.verbose)
-  add_subworlds(s, args.verbose)
-  add_files(s, args.imagedir, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose)
-  add_protocols(s, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose)
-  s.commit()
+  with profiler.phase('create_tables', dbfile):
+    if args.in_memory:
+      s = memory_session(args)
+    else:
+      create_tables(args)
+      s = session_try_nolock(args.type, args.files[0], echo=(args.verbose >= 2))
+
+  with profiler.phase('add_clients', dbfile) as p:
+    n = count_rows(s, Client.__table__)
+    add_clients(s, args.subjectlist, args.verbose)
+    s.flush()
+    p['rows'] = count_rows(s, Client.__table__) - n
+
+  with profiler.phase('add_subworlds', dbfile) as p:
+    n = count_rows(s, subworld_client_association)
+    add_subworlds(s, args.verbose, SUBWORLDS + tuple(read_subworlds(args.subworlds) if args.subworlds else ()))
+    p['rows'] = count_rows(s, subworld_client_association) - n
+
+  with profiler.phase('add_files', dbfile) as p:
+    n = count_rows(s, File.__table__)
+    first_file_id = add_files(s, profiler.timed(records, p, 'crawl_seconds'), not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose, lambda n: profiler.progress(p, n, 'files'))
+    p['rows'] = count_rows(s, File.__table__) - n
+  # the crawl is interleaved with the inserts
+  p['insert_seconds'] = p['seconds'] - p['crawl_seconds']
+
+  with profiler.phase('add_ordinals', dbfile) as p:
+    add_ordinals(s, args.verbose)
+    p['rows'] = count_rows(s, File.__table__)
+
+  with profiler.phase('add_protocols', dbfile) as p:
+    n = count_rows(s, protocolPurpose_file_association)
+    add_protocols(s, not args.noilluminations, args.poses, args.expressions, args.highresolutions, args.verbose, first_file_id)
+    p['rows'] = count_rows(s, protocolPurpose_file_association) - n
+
+  with profiler.phase('create_indexes', dbfile):
+    create_indexes(s, args.verbose)
+
+  with profiler.phase('commit', dbfile):
+    s.commit()
+
+  if args.in_memory:
+    with profiler.phase('save', dbfile):
+      save_database(s, dbfile, args.verbose, not args.no_optimize)
+  elif not args.no_optimize:
+    with profiler.phase('optimize', dbfile):
+      optimize(raw_connection(s), args.verbose)
   s.close()
 
+def create(args):
+  """Creates or re-creates this database"""
+
+  import copy
+
+  variants = [args]
+  for output, flags in args.variants or ():
+    v = copy.copy(args)
+    v.files = [output]
+    v.noilluminations, v.poses, v.expressions, v.highresolutions = ('I' in flags, 'P' in flags, 'E' in flags, 'H' in flags)
+    variants.append(v)
+
+  profiler = Profiler(args.verbose)
+  profiler.start()
+  try:
+    if len(variants) == 1:
+      build_database(args, file_records(args), profiler)
+    else:
+      # a single crawl, with the files needed by any of the variants, serves them all
+      union = copy.copy(args)
+      union.poses = any(v.poses for v in variants)
+      union.highresolutions = any(v.highresolutions for v in variants)
+      with profiler.phase('crawl') as p:
+        records = list(file_records(union))
+        p['rows'] = len(records)
+      for v in variants:
+        if args.verbose: print("Creating database variant '%s'..." % v.files[0])
+        build_database(v, records, profiler)
+  finally:
+    profiler.stop()
+  if args.profile_report:
+    profiler.write_report(args.profile_report)
+
 def add_command(subparsers):
   """Add specific subcommands that the action "create" can use"""
 
   parser = subparsers.add_parser('create', help=create.__doc__)
 
   parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
-  parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way")
+  parser.add_argument('-U', '--update', action='store_true', help="If set, the current database is kept and only the clients, files and protocols that it misses (given the other options) are added")
+  parser.add_argument('-M', '--in-memory', action='store_true', help="If set, the database is built in memory and written to its file in one go at the end, replacing the current database atomically")
+  parser.add_argument('--no-optimize', action='store_true', help="If set, the final ANALYZE and VACUUM of the database are skipped")
+  parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way; once prints the timing of each phase and the progress of the files, twice also echoes the SQL statements and three times prints every added file")
+  parser.add_argument('--profile-report', metavar='FILE', help="If given, the wall time, the number of added rows and SQL statements and the peak memory of each phase are written to FILE in JSON format")
   parser.add_argument('-D', '--imagedir', metavar='DIR', default='/idiap/resource/database/Multi-Pie/data', help="Change the relative path to the directory containing the images of the Multi-PIE database.")
   parser.add_argument('--subjectlist', default='/idiap/resource/database/Multi-Pie/meta/subject_list.txt', help="Change the file containing the subject list of the Multi-PIE database.")
+  parser.add_argument('--subworlds', metavar='FILE', help="If given, the splits of the world set listed in FILE are added to the default ones; each line holds the name of a subworld followed by the ids of its clients, e.g., 'sub200 7 12 13 ...'")
   parser.add_argument('-I', '--noilluminations', action='store_true', help='If set, it will not add the illumination files (and corresponding protocols) in the database')
   parser.add_argument('-P', '--poses', action='store_true', help='If set, it will add the pose files (and corresponding protocols) in the database')
   parser.add_argument('-E', '--expressions', action='store_true', help='If set, it will add the expression files (and corresponding protocols) in the database')
   parser.add_argument('-H', '--highresolutions', action='store_true', help='If set, it will add the high-resolution files (and corresponding protocols) in the database')
+  parser.add_argument('--variant', dest='variants', metavar='OUTPUT[:FLAGS]', type=variant, action='append', help="Creates the database variant OUTPUT in the same run, from the same crawl of the image directory; FLAGS combines the letters I, P, E and H, which replace the options -I, -P, -E and -H for this variant (e.g., 'pose.sql3:P'). Can be given several times")
+  parser.add_argument('-T', '--threads', type=int, default=1, help='The number of threads crawling the session/client directories of the image directory in parallel')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='The number of processes listing and parsing the session/client directories of the image directory in parallel; the database itself is written by the main process only')
+  parser.add_argument('--manifest', metavar='FILE', help="If given and FILE exists, the files are read from this manifest instead of crawling the image directory; otherwise, the image directory is crawled completely and its listing is written to FILE")
+  parser.add_argument('--check-manifest', action='store_true', help="If set, the manifest is only used if the root listing of the image directory still matches the checksum stored in the manifest")
 
   parser.set_defaults(func=create) #action
@@ -117,6 +117,38 @@ def path(args):
 
   return 0
 
+def precompute(args):
+  """Stores the file lists of all protocols in the persistent cache"""
+
+  from .query import Database
+  db = Database()
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  count = db.precompute(args.cache_directory)
+  output.write('%d file lists stored in "%s"\n' % (count, db.m_file_lists.m_directory))
+
+  return 0
+
+def snapshot(args):
+  """Exports the tables to a memory-mapped snapshot for Database(snapshot=...)"""
+
+  from .query import Database
+  db = Database()
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  directory = db.export_snapshot(args.directory)
+  output.write('snapshot written to "%s"\n' % directory)
+
+  return 0
+
 class Interface(BaseInterface):
 
   def name(self):
@@ -183,3 +215,17 @@ class Interface(BaseInterface):
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=path) #action
 
+    # adds the "precompute" command
+    from .query import CACHE_DIRECTORY
+    parser = subparsers.add_parser('precompute', help=precompute.__doc__)
+    parser.add_argument('-D', '--cache-directory', default=CACHE_DIRECTORY, help="the directory of the file list cache, which is given as cache_directory to the Database constructor (defaults to '%(default)s').")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=precompute) #action
+
+    # adds the "snapshot" command
+    from .query import SNAPSHOT_DIRECTORY
+    parser = subparsers.add_parser('snapshot', help=snapshot.__doc__)
+    parser.add_argument('-D', '--directory', default=SNAPSHOT_DIRECTORY, help="the directory of the snapshot, which is given as snapshot to the Database constructor (defaults to '%(default)s').")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=snapshot) #action
+
@@ -21,9 +21,9 @@
 
 import os, numpy
 import bob.db.base.utils
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_, not_
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Index, or_, and_, not_
 from bob.db.base.sqlalchemy_migration import Enum, relationship
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, deferred
 from sqlalchemy.ext.declarative import declarative_base
 
 import bob.db.verification.utils
@@ -32,16 +32,23 @@ Base = declarative_base()
 
 subworld_client_association = Table('subworld_client_association', Base.metadata,
   Column('subworld_id', Integer, ForeignKey('subworld.id')),
-  Column('client_id',  Integer, ForeignKey('client.id')))
+  Column('client_id',  Integer, ForeignKey('client.id')),
+  # covering indexes for joins in both directions
+  Index('ix_subworld_client_association_subworld_client', 'subworld_id', 'client_id'),
+  Index('ix_subworld_client_association_client_subworld', 'client_id', 'subworld_id'))
 
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
   Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id',  Integer, ForeignKey('file.id')))
+  Column('file_id',  Integer, ForeignKey('file.id')),
+  # covering indexes for joins in both directions
+  Index('ix_protocolPurpose_file_association_purpose_file', 'protocolPurpose_id', 'file_id'),
+  Index('ix_protocolPurpose_file_association_file_purpose', 'file_id', 'protocolPurpose_id'))
 
 class Client(Base):
   """Database clients, marked by an integer identifier and the group they belong to"""
 
   __tablename__ = 'client'
+  __table_args__ = (Index('ix_client_sgroup', 'sgroup', 'id'),)
 
   # Key identifier for the client
   id = Column(Integer, primary_key=True)
@@ -95,6 +102,12 @@ class File(Base, bob.db.verification.utils.File):
   """Generic file container"""
 
   __tablename__ = 'file'
+  # matches the client filters and the ordering of Database.objects()
+  __table_args__ = (Index('ix_file_client_session_recording', 'client_id', 'session_id', 'recording_id', 'id'),
+                    Index('ix_file_session_recording', 'session_id', 'recording_id'),
+                    Index('ix_file_expression', 'expression_id'),
+                    Index('ix_file_session_ordinal', 'session_ordinal'),
+                    Index('ix_file_shot_ordinal', 'shot_ordinal'))
 
   # Key identifier for the file
   id = Column(Integer, primary_key=True)
@@ -111,6 +124,14 @@ class File(Base, bob.db.verification.utils.File):
   img_type = Column(Enum(*imagetype_choices))
   # Identifier of the expression
   expression_id = Column(Integer, ForeignKey('expression.id'))
+  # Derived from the sessions of the client by create (see add_ordinals()):
+  # the number (1 to 4) of the recorded session of the client, as selected by
+  # the world_first to world_fourth options of Database.objects(); deferred,
+  # so that File objects can still be loaded from databases without them
+  session_ordinal = deferred(Column(Integer))
+  # the position of the shot in the sequence of shots of the client, as
+  # selected by the world_nshots option (None for highres images)
+  shot_ordinal = deferred(Column(Integer))
 
   # for Python
   client = relationship("Client", backref=backref("files", order_by=id))
@@ -128,6 +149,8 @@ class FileMultiview(Base):
   """Additional file information for multiview-like files"""
 
   __tablename__ = 'fileMultiview'
+  __table_args__ = (Index('ix_fileMultiview_camera_shot', 'camera_id', 'shot_id'),
+                    Index('ix_fileMultiview_shot', 'shot_id'))
 
   # Key identifier for the file multiview
   id = Column(Integer, ForeignKey('file.id'), primary_key=True) # for SQL
@@ -201,6 +224,7 @@ class ProtocolPurpose(Base):
   """Multi-PIE protocol purposes"""
 
   __tablename__ = 'protocolPurpose'
+  __table_args__ = (Index('ix_protocolPurpose_protocol_group_purpose', 'protocol_id', 'sgroup', 'purpose'),)
 
   # Unique identifier for this protocol purpose object
   id = Column(Integer, primary_key=True)
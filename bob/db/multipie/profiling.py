@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Laurent El Shafey <Laurent.El-Shafey@idiap.ch>
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing and progress instrumentation for the creation of the database.
+"""
+
+import sys
+import time
+import json
+import contextlib
+
+try:
+  import resource
+except ImportError:
+  # not available on Windows
+  resource = None
+
+def peak_rss():
+  """Returns the peak resident set size of this process in kilobytes, or None
+     if it cannot be determined"""
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # bytes on Mac OS X, kilobytes elsewhere
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+class Profiler(object):
+  """Records the wall time, the number of added rows, the number of SQL
+     statements and the peak memory of the phases of a database creation.
+
+     While the profiler is started, all statements sent by any SQLAlchemy engine
+     are counted."""
+
+  def __init__(self, verbose = 0, interval = 2.):
+    self.m_verbose = verbose
+    self.m_interval = interval
+    self.m_phases = []
+    self.m_statements = 0
+    self.m_start = None
+    self.m_last_progress = 0.
+    self.m_phase_start = None
+
+  def _count(self, *args, **kwargs):
+    self.m_statements += 1
+
+  def start(self):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, 'before_cursor_execute', self._count)
+    self.m_start = time.time()
+
+  def stop(self):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.remove(Engine, 'before_cursor_execute', self._count)
+
+  @contextlib.contextmanager
+  def phase(self, name, database = None):
+    """Measures the enclosed block as one phase. The yielded dictionary is
+       stored in the report; set its 'rows' key to the number of rows added."""
+    record = {'name' : name, 'database' : database, 'rows' : None}
+    start, statements = time.time(), self.m_statements
+    self.m_phase_start = self.m_last_progress = start
+    yield record
+    record['seconds'] = time.time() - start
+    record['statements'] = self.m_statements - statements
+    record['peak_rss_kb'] = peak_rss()
+    if record['rows'] is not None and record['seconds'] > 0:
+      record['rows_per_second'] = record['rows'] / record['seconds']
+    self.m_phases.append(record)
+    if self.m_verbose: print(self.summary(record))
+
+  def timed(self, iterable, record, key):
+    """Passes the elements of iterable through, while adding the time spent in
+       producing them to record[key]"""
+    record[key] = 0.
+    iterator = iter(iterable)
+    while True:
+      start = time.time()
+      try:
+        element = next(iterator)
+      except StopIteration:
+        record[key] += time.time() - start
+        return
+      record[key] += time.time() - start
+      yield element
+
+  def progress(self, record, count, what = 'rows'):
+    """Prints a progress line for the given phase, at most once per interval"""
+    now = time.time()
+    if self.m_verbose and now - self.m_last_progress >= self.m_interval:
+      self.m_last_progress = now
+      print("%s: %d %s so far (%.0f %s/s)" % (record['name'], count, what, count / (now - self.m_phase_start), what))
+
+  def summary(self, record):
+    """Returns a line summarizing the given phase"""
+    s = "%s took %.2f s, %d statements" % (record['name'], record['seconds'], record['statements'])
+    if record['rows'] is not None:
+      s += ", %d rows (%.0f rows/s)" % (record['rows'], record.get('rows_per_second', 0.))
+    if record['peak_rss_kb'] is not None:
+      s += ", peak RSS %.1f MB" % (record['peak_rss_kb'] / 1024.)
+    return s
+
+  def report(self):
+    """Returns the recorded phases and totals as a dictionary"""
+    return {
+        'seconds' : time.time() - self.m_start,
+        'statements' : self.m_statements,
+        'peak_rss_kb' : peak_rss(),
+        'phases' : self.m_phases,
+        }
+
+  def write_report(self, filename):
+    """Writes the report in JSON format to the given file"""
+    with open(filename, 'w') as f:
+      json.dump(self.report(), f, indent=2, sort_keys=True)
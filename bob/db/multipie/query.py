@@ -21,14 +21,67 @@ Multi-PIE database in the most obvious ways.
 """
 
 import os
+import collections
+try:
+  from collections.abc import Iterable
+except ImportError:
+  # Python 2
+  from collections import Iterable
 from bob.db.base import utils
 from .models import *
 from .driver import Interface
+from .cache import LRUCache, FileListCache, file_stamp, database_fingerprint, permissions
+from .columnar import Columns, isin, string_dtype, world_nshots_limits
 
 import bob.db.verification.utils
 
 SQLITE_FILE = Interface().files()[0]
 
+# the default directory of the persistent file list cache
+CACHE_DIRECTORY = SQLITE_FILE + '.cache'
+
+# the default directory of the memory-mapped snapshot of the tables
+SNAPSHOT_DIRECTORY = SQLITE_FILE + '.snapshot'
+
+# bug in subject_list.txt (57 instead of 1957)
+VALID_BIRTHYEARS = tuple(range(1900, 2050)) + (57,)
+
+Metadata = collections.namedtuple('Metadata', ('protocol_names', 'subworld_names', 'expression_names', 'camera_names',
+    'expression_ids', 'camera_ids', 'purpose_ids'))
+"""The names stored in the database, as tuples in the order of their ids, and
+the ids of the expressions and cameras by name and of the protocol purposes by
+(protocol name, group, purpose), as dictionaries."""
+
+class FileRow(collections.namedtuple('FileRow', ('id', 'client_id', 'path', 'session_id', 'recording_id', 'shot_id', 'camera', 'expression'))):
+  """A file of the database as a plain tuple, as returned by objects_rows().
+  shot_id and camera are None for highres images."""
+
+  __slots__ = ()
+
+  def make_path(self, directory = None, extension = None):
+    """Wraps the current path so that a complete path is formed, like File.make_path()"""
+    return str(os.path.join(directory or '', self.path + (extension or '')))
+
+Trials = collections.namedtuple('Trials', ('model_ids', 'probe_ids', 'probe_client_ids', 'genuine'))
+"""The trials of a protocol, as returned by Database.trials(): the model ids,
+the ids of the probe files and of their clients, and the matrix of the genuine
+trials (one row per model, one column per probe)."""
+
+# the order of the Files returned by objects()
+FILE_ORDER = (File.client_id, File.session_id, File.recording_id, File.id)
+
+def _shard_ids(ids, shard, num_shards):
+  """Returns the given file ids (a numpy array) of the given shard, see objects()"""
+  return ids if num_shards == 1 else ids[ids % num_shards == shard]
+
+def _file_order(f):
+  """The sort key of a File in the order of FILE_ORDER"""
+  return (f.client_id, f.session_id, f.recording_id, f.id)
+
+def _key(values):
+  """Normalizes a list argument for the use in the key of a cached result"""
+  return None if not values else tuple(sorted(values))
+
 class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.utils.ZTDatabase):
   """The dataset class opens and maintains a connection opened to the Database.
 
@@ -36,9 +89,46 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   and for the data itself inside the database.
   """
 
-  def __init__(self, original_directory = None, original_extension = '.png', annotation_directory = None, annotation_extension = '.pos'):
+  def __init__(self, original_directory = None, original_extension = '.png', annotation_directory = None, annotation_extension = '.pos', cache_entries = 0, cache_objects = None, cache_directory = None, columnar = False, snapshot = None):
+    """If cache_entries is greater than 0, the results of objects() and
+    clients() are kept in a least recently used cache of that many results,
+    with at most cache_objects objects in all results together (if given).
+    The cache is emptied and the database re-opened when the modification time
+    or the size of the database file change.
+
+    If cache_directory is given (True selects CACHE_DIRECTORY, next to the
+    database file), the file lists of the protocols are stored in this directory
+    when first needed (see precompute()). objects() calls that only select by
+    protocol, purposes, model_ids, groups and classes then read these lists
+    instead of joining the tables of the database.
+
+    If columnar is True, the tables are loaded into numpy columns when first
+    needed (see columnar.Columns), and objects() and clients() select their
+    results from these columns. The results are the same as with SQL. All File
+    and Client objects are read from the database once, by the first
+    selection, and kept, so that no later selection queries the database.
+
+    If snapshot is given (True selects SNAPSHOT_DIRECTORY), the columns are
+    memory-mapped from the snapshot written by export_snapshot() instead of
+    being loaded from the database, which implies columnar. All processes
+    that use the same snapshot share its pages."""
+
     # NOTE: The default original extension '.png' is only valid for the "multiview" data, but not for the "highres" images, which are stored as '.jpg'
 
+    # filled on first use by metadata(); needs to exist before the base class constructors probe objects()
+    self.m_metadata = None
+    self.m_cache = LRUCache(cache_entries, cache_objects) if cache_entries > 0 else None
+    self.m_file_lists = None if not cache_directory else FileListCache(CACHE_DIRECTORY if cache_directory is True else cache_directory)
+    self.m_snapshot = SNAPSHOT_DIRECTORY if snapshot is True else snapshot
+    self.m_columnar = columnar or bool(self.m_snapshot)
+    self.m_columns = None
+    # the File and Client objects by id, for the columnar selections, see _objects_by_id()
+    self.m_objects_by_id = None
+    # whether the database has the columns File.session_ordinal and File.shot_ordinal, see _has_ordinals()
+    self.m_ordinals = None
+    # modification time and size of the database file, when first used
+    self.m_stamp = None
+
     # call base class constructors
     bob.db.verification.utils.SQLiteDatabase.__init__(self, SQLITE_FILE, File)
     bob.db.verification.utils.ZTDatabase.__init__(self, original_directory=original_directory, original_extension=original_extension)
@@ -47,6 +137,124 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
     self.annotation_directory = annotation_directory
     self.annotation_extension = annotation_extension
 
+  def _refresh(self):
+    """Empties the result cache and re-opens the database, if the database file
+    has changed since it was opened"""
+
+    if self.m_cache is None or not self.is_valid():
+      return
+    stamp = file_stamp(self.m_sqlite_file)
+    if self.m_stamp is None:
+      self.m_stamp = stamp
+    elif stamp != self.m_stamp:
+      self.m_cache.clear()
+      self.m_metadata = None
+      self.m_columns = None
+      self.m_objects_by_id = None
+      self.m_ordinals = None
+      self.m_session.close()
+      self.m_session.bind.dispose()
+      self.m_session = utils.session_try_readonly('sqlite', self.m_sqlite_file)
+      self.m_stamp = stamp
+
+  def columns(self):
+    """Returns the tables of the database as numpy columns, which are loaded
+    on first use, from the snapshot if one was given to the constructor"""
+
+    if self.m_columns is None:
+      self.assert_validity()
+      if self.m_snapshot:
+        columns, fingerprint = Columns.load(self.m_snapshot)
+        if fingerprint != database_fingerprint(self.m_sqlite_file):
+          raise IOError("The snapshot '%s' was not exported from the current database file '%s'; export it again" % (self.m_snapshot, self.m_sqlite_file))
+        self.m_columns = columns
+      else:
+        self.m_columns = Columns(self.m_session)
+    return self.m_columns
+
+  def export_snapshot(self, directory = None):
+    """Writes the tables of the database as numpy columns to the given
+    directory (SNAPSHOT_DIRECTORY by default), which can then be given as
+    snapshot to the constructor. Returns the directory."""
+
+    import shutil
+    import tempfile
+    directory = (directory or SNAPSHOT_DIRECTORY).rstrip(os.sep)
+    self.assert_validity()
+    # written next to the target first, so that no process maps a partial
+    # snapshot, in a directory of its own for concurrent exports
+    parent, prefix = os.path.dirname(directory) or '.', os.path.basename(directory) + '.'
+    tmpname = tempfile.mkdtemp(prefix=prefix, suffix='.tmp', dir=parent)
+    try:
+      Columns(self.m_session).save(tmpname, database_fingerprint(self.m_sqlite_file))
+      # mkdtemp only gives access to the owner
+      os.chmod(tmpname, permissions(0o777))
+      for attempt in range(10):
+        try:
+          os.rename(tmpname, directory)
+          return directory
+        except OSError:
+          if not os.path.exists(directory):
+            raise
+        # moved aside first, since rename() does not replace a non-empty
+        # directory; another export may have moved it or renamed its own in the meantime
+        old = tempfile.mkdtemp(prefix=prefix, suffix='.old', dir=parent)
+        try:
+          os.rename(directory, os.path.join(old, 'snapshot'))
+        except OSError:
+          if os.path.exists(directory):
+            raise
+        finally:
+          shutil.rmtree(old, ignore_errors=True)
+      raise OSError("The snapshot '%s' could not be replaced, since other exports kept re-creating it" % directory)
+    finally:
+      # only left if the snapshot was not renamed to directory
+      if os.path.exists(tmpname):
+        shutil.rmtree(tmpname, ignore_errors=True)
+
+  def _cached(self, key, compute):
+    """Returns the result of compute(), from the result cache if enabled"""
+
+    if self.m_cache is None:
+      return compute()
+    return self.m_cache.get(key, compute)
+
+  def cache_info(self):
+    """Returns the hits, misses and occupancy of the result cache as a
+    dictionary, or None if results are not cached"""
+
+    return None if self.m_cache is None else self.m_cache.info()
+
+  def metadata(self):
+    """Returns the names of the protocols, subworlds, expressions and cameras.
+
+    They are read once from the database and kept for the lifetime of this
+    object, so that parameter validation does not need to query the database.
+    """
+
+    if self.m_metadata is None and self.m_snapshot:
+      self.m_metadata = Metadata(*(self.columns().names() + self.columns().ids()))
+    elif self.m_metadata is None:
+      expressions = [(str(n), i) for (i, n) in self.query(Expression.id, Expression.name).order_by(Expression.id)]
+      cameras = [(str(n), i) for (i, n) in self.query(Camera.id, Camera.name).order_by(Camera.id)]
+      self.m_metadata = Metadata(
+          tuple(str(n) for (n,) in self.query(Protocol.name).order_by(Protocol.id)),
+          tuple(str(n) for (n,) in self.query(Subworld.name).order_by(Subworld.id)),
+          tuple(n for (n, i) in expressions),
+          tuple(n for (n, i) in cameras),
+          dict(expressions),
+          dict(cameras),
+          dict(((str(p), str(g), str(u)), i) for (i, p, g, u) in
+              self.query(ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose).join(Protocol)))
+    return self.m_metadata
+
+  def _purpose_ids(self, protocol, groups, purpose = None):
+    """Returns the sorted ids of the protocol purposes of the given protocols
+    and groups (and purpose, if given), from the metadata"""
+
+    return sorted(i for ((p, g, u), i) in self.metadata().purpose_ids.items()
+        if p in protocol and g in groups and (purpose is None or u == purpose))
+
   def groups(self, protocol=None):
     """Returns the names of all registered groups"""
 
@@ -65,14 +273,12 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def has_subworld(self, name):
     """Tells if a certain subworld is available"""
 
-    return self.query(Subworld).filter(Subworld.name==name).count() != 0
+    return name in self.metadata().subworld_names
 
   def subworld_names(self):
     """Returns all registered subworld names"""
 
-    l = self.subworlds()
-    retval = [str(k.name) for k in l]
-    return retval
+    return list(self.metadata().subworld_names)
 
   def expressions(self):
     """Returns the list of expressions"""
@@ -82,14 +288,12 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def has_expression(self, name):
     """Tells if a certain expression is available"""
 
-    return self.query(Expression).filter(Expression.name==name).count() != 0
+    return name in self.metadata().expression_names
 
   def expression_names(self):
     """Returns all registered expression names"""
 
-    l = self.expressions()
-    retval = [str(k.name) for k in l]
-    return retval
+    return list(self.metadata().expression_names)
 
   def cameras(self):
     """Returns the list of cameras"""
@@ -99,12 +303,12 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def has_camera(self, name):
     """Tells if a certain camera is available"""
 
-    return self.query(Camera).filter(Camera.name==name).count() != 0
+    return name in self.metadata().camera_names
 
   def camera_names(self):
     """Returns all registered camera names"""
 
-    return [str(c.name) for c in self.cameras()]
+    return list(self.metadata().camera_names)
 
   def clients(self, protocol=None, groups=None, subworld=None, genders=None, birthyears=None):
     """Returns a set of Clients for the specific query by the user.
@@ -131,16 +335,80 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
     Returns: A list containing all the Clients which have the given properties.
     """
 
-    VALID_BIRTHYEARS = list(range(1900, 2050))
-    VALID_BIRTHYEARS.append(57) # bug in subject_list.txt (57 instead of 1957)
-    protocol = self.check_parameters_for_validity(protocol, 'protocol', self.protocol_names())
+    self._refresh()
+    groups, subworld, genders, birthyears, birthyear_filter = self._clients_parameters(protocol, groups, subworld, genders, birthyears)
+    key = ('clients', _key(groups), _key(subworld), _key(genders), _key(birthyears))
+    if self.m_columnar:
+      return self._cached(key, lambda: self._clients_by_id(self.columns().client_ids(groups, subworld, genders, birthyears)))
+    return self._cached(key, lambda: self._clients(groups, subworld, genders, birthyear_filter))
+
+  def _objects_by_id(self):
+    """Returns the File and Client objects of the database as two dictionaries
+    by id, which are read in two queries when first needed and then kept"""
+
+    if self.m_objects_by_id is None:
+      self.m_objects_by_id = (dict((f.id, f) for f in self.query(File)), dict((c.id, c) for c in self.query(Client)))
+    return self.m_objects_by_id
+
+  def _clients_by_id(self, ids):
+    """Returns the Client objects with the given ids, in the given order"""
+
+    clients = self._objects_by_id()[1]
+    return [clients[i] for i in ids.tolist()]
+
+  def _files_by_id(self, ids):
+    """Returns the File objects with the given ids, in the given order"""
+
+    files = self._objects_by_id()[0]
+    return [files[i] for i in ids.tolist()]
+
+  def clients_array(self, protocol=None, groups=None, subworld=None, genders=None, birthyears=None):
+    """Returns the clients of clients(), with the same parameters and in the same
+    order, as a numpy structured array with the fields id, sgroup, birthyear,
+    gender, first_session, second_session, third_session and fourth_session.
+    sgroup and gender are byte strings."""
+
+    import numpy
+    self._refresh()
+    groups, subworld, genders, birthyears, birthyear_filter = self._clients_parameters(protocol, groups, subworld, genders, birthyears)
+    columns = (Client.id, Client.sgroup, Client.birthyear, Client.gender, Client.first_session, Client.second_session, Client.third_session, Client.fourth_session)
+    rows = []
+    for q in self._clients_queries(groups, subworld, genders, birthyear_filter):
+      rows += self.m_session.execute(q.with_entities(*columns).statement).fetchall()
+    dtype = [('id', numpy.int32), ('sgroup', string_dtype(Client.group_choices, 'S')), ('birthyear', numpy.int16), ('gender', string_dtype(Client.gender_choices, 'S')),
+             ('first_session', numpy.int8), ('second_session', numpy.int8), ('third_session', numpy.int8), ('fourth_session', numpy.int8)]
+    return numpy.array([(r[0], r[1].encode('ascii'), r[2], r[3].encode('ascii'), r[4], r[5], r[6], r[7]) for r in rows], dtype=dtype)
+
+  def _clients_parameters(self, protocol, groups, subworld, genders, birthyears):
+    """Validates the parameters of clients() and returns them, together with the
+    filter on the birth years"""
+
+    metadata = self.metadata()
+    protocol = self.check_parameters_for_validity(protocol, 'protocol', metadata.protocol_names)
     groups = self.check_parameters_for_validity(groups, 'group', self.groups())
     if subworld:
-      subworld = self.check_parameters_for_validity(subworld, 'subworld', self.subworld_names())
+      subworld = self.check_parameters_for_validity(subworld, 'subworld', metadata.subworld_names)
     genders = self.check_parameters_for_validity(genders, 'gender', self.genders())
-    birthyears = self.check_parameters_for_validity(birthyears, 'birthyear', VALID_BIRTHYEARS)
+    if birthyears is None:
+      # all valid birth years, without sending them as a list
+      birthyear_filter = or_(Client.birthyear.between(1900, 2049), Client.birthyear == 57)
+    else:
+      birthyears = self.check_parameters_for_validity(birthyears, 'birthyear', VALID_BIRTHYEARS)
+      birthyear_filter = Client.birthyear.in_(birthyears)
+    return groups, subworld, genders, birthyears, birthyear_filter
+
+  def _clients(self, groups, subworld, genders, birthyear_filter):
+    """Queries the clients for the validated parameters of clients()"""
 
-    # List of the clients
+    retval = []
+    for q in self._clients_queries(groups, subworld, genders, birthyear_filter):
+      retval += list(q)
+    return retval
+
+  def _clients_queries(self, groups, subworld, genders, birthyear_filter):
+    """Returns the queries of the clients for the validated parameters of clients()"""
+
+    # List of the queries
     retval = []
     # World data
     if "world" in groups:
@@ -149,23 +417,24 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
         q = q.join((Subworld, Client.subworld)).filter(Subworld.name.in_(subworld))
       q = q.filter(Client.sgroup == 'world').\
             filter(Client.gender.in_(genders)).\
-            filter(Client.birthyear.in_(birthyears)).\
+            filter(birthyear_filter).\
             order_by(Client.id)
-      retval += list(q)
+      retval.append(q)
     # dev / eval data
     if 'dev' in groups or 'eval' in groups:
       q = self.query(Client).\
             filter(and_(Client.sgroup != 'world', Client.sgroup.in_(groups))).\
             filter(Client.gender.in_(genders)).\
-            filter(Client.birthyear.in_(birthyears)).\
+            filter(birthyear_filter).\
             order_by(Client.id)
-      retval += list(q)
+      retval.append(q)
     return retval
 
   def has_client_id(self, id):
     """Returns True if we have a client with a certain integer identifier"""
 
-    return self.query(Client).filter(Client.id==id).count() != 0
+    from sqlalchemy import exists
+    return self.query(exists().where(Client.id==id)).scalar()
 
   def client(self, id):
     """Returns the Client object in the database given a certain id. Raises
@@ -298,7 +567,7 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
       classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
       world_noflash=False, world_first=False, world_second=False, world_third=False,
-      world_fourth=False, world_nshots=None, world_shots=None):
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1):
     """Returns a set of Files for the specific query by the user.
 
     Keyword Parameters:
@@ -378,56 +647,350 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
       Only uses data from the fourth recorded session of each user of the world
       dataset.
 
-    Returns: A set of Files with the given properties.
+    shard, num_shards
+      Only retrieves the files whose id modulo num_shards is shard, e.g., to
+      split the files over num_shards grid jobs. The files of all shards
+      together are the files without sharding. By default, all files are
+      retrieved.
+
+    Returns: A list of Files with the given properties, without duplicates.
+    The Files are sorted by client id, session id, recording id and file id.
+    """
+
+    self._refresh()
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    self._check_shard(shard, num_shards)
+
+    key = ('objects', _key(protocol), _key(purposes), _key(model_ids), _key(groups), _key(classes), _key(subworld),
+           _key(expressions), _key(cameras), world_sampling, world_noflash, world_first, world_second, world_third,
+           world_fourth, world_nshots, _key(world_shots), shard, num_shards)
+    if self.m_columnar:
+      return self._cached(key, lambda: self._files_by_id(_shard_ids(self.columns().object_ids(protocol, purposes, model_ids, groups, classes, subworld,
+          expressions, cameras, world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots),
+          shard, num_shards)))
+    if self.m_file_lists is not None and not (subworld or expressions or cameras or world_sampling != 1 or world_noflash or
+        world_first or world_second or world_third or world_fourth or world_nshots or world_shots):
+      return self._cached(key, lambda: self._objects_from_file_lists(protocol, purposes, model_ids, groups, classes, shard, num_shards))
+    return self._cached(key, lambda: self._objects(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+        world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots,
+        shard=shard, num_shards=num_shards))
+
+  def iter_objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+      world_noflash=False, world_first=False, world_second=False, world_third=False,
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1, batch_size=1000):
+    """Yields the Files of objects() one by one, with the same parameters and in
+    the same order, without building the complete list first.
+
+    The Files are fetched from the database in batches of batch_size, in a
+    session of their own, which is closed when the iteration ends. When the
+    next batch is started, the Files of the previous batch are removed from
+    that session, so that the memory stays bounded. The attributes of these
+    Files, e.g., for make_path(), are still available, but their
+    relationships (like File.client) cannot be loaded anymore. The Files
+    returned by objects() are not affected.
+    """
+
+    from sqlalchemy.orm import Session
+    self._refresh()
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    self._check_shard(shard, num_shards)
+    q = self._objects_query(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+        world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots,
+        shard=shard, num_shards=num_shards)
+    if q is None:
+      return
+
+    # the identity map of self.m_session holds the Files of objects() (and of
+    # the result cache), which must not be expunged with the streamed ones
+    session = Session(bind=self.m_session.bind)
+    try:
+      batch = []
+      for f in q.with_session(session).yield_per(batch_size):
+        if len(batch) == batch_size:
+          for g in batch:
+            session.expunge(g)
+          batch = []
+        batch.append(f)
+        yield f
+    finally:
+      session.close()
+
+  def objects_page(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+      world_noflash=False, world_first=False, world_second=False, world_third=False,
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1, after=None, limit=1000):
+    """Returns a page of at most limit Files of objects(), with the same
+    parameters and in the same order.
+
+    The page starts after the File (or FileRow) given as after, which is the
+    last File of the previous page; with None, the first page is returned.
+    An empty list marks the end. Each page is a single query that continues
+    from the key of the last File with the index of the file order, instead of
+    skipping the previous pages, so that fetching a page costs the same at
+    any position.
+    """
+
+    self._refresh()
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    self._check_shard(shard, num_shards)
+    q = self._objects_query(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+        world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots,
+        shard=shard, num_shards=num_shards)
+    if q is None:
+      return []
+    if after is not None:
+      # (client_id, session_id, recording_id, id) > the key of after, see FILE_ORDER
+      q = q.filter(or_(File.client_id > after.client_id, and_(File.client_id == after.client_id,
+            or_(File.session_id > after.session_id, and_(File.session_id == after.session_id,
+            or_(File.recording_id > after.recording_id, and_(File.recording_id == after.recording_id, File.id > after.id)))))))
+    return q.limit(limit).all()
+
+  def objects_rows(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+      world_noflash=False, world_first=False, world_second=False, world_third=False,
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1):
+    """Returns the files of objects(), with the same parameters and in the same
+    order, as a list of FileRow's.
+
+    The rows are read with a single SQL statement, or from the numpy columns
+    if columnar, without creating File objects, and they can be pickled
+    cheaply to be sent to other processes. With SQL, this takes about two
+    thirds of the time of objects() with SQL; from the columns, about a
+    seventh.
+    """
+
+    args = (protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras, world_sampling, world_noflash,
+        world_first, world_second, world_third, world_fourth, world_nshots, world_shots, shard, num_shards)
+    # the names are taken from the metadata instead of joining their tables
+    metadata = self.metadata()
+    cameras = dict((i, n) for (n, i) in metadata.camera_ids.items())
+    expressions = dict((i, n) for (n, i) in metadata.expression_ids.items())
+    if self.m_columnar:
+      return [FileRow(r[0], r[1], r[2].decode('ascii'), r[3], r[4], None if r[5] < 0 else r[5], cameras.get(r[6]), expressions.get(r[7]))
+          for r in self.objects_array(*args).tolist()]
+    return [FileRow(*(tuple(r[:6]) + (cameras.get(r[6]), expressions.get(r[7])))) for r in self._object_rows(*args)]
+
+  def objects_array(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+      world_noflash=False, world_first=False, world_second=False, world_third=False,
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1):
+    """Returns the files of objects(), with the same parameters and in the same
+    order, as a compact numpy structured array with the fields id, client_id,
+    path (a byte string), session_id, recording_id, shot_id, camera_id and
+    expression_id. For highres images, shot_id and camera_id are -1. The names
+    of the camera and expression ids are given by the camera_ids and
+    expression_ids of metadata().
+
+    With SQL, this takes about two thirds of the time of objects() with SQL;
+    if columnar, the array is selected from the numpy columns, in about a
+    twentieth of that time.
     """
 
-    protocol = self.check_parameters_for_validity(protocol, 'protocol', self.protocol_names())
+    import numpy
+    args = (protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras, world_sampling, world_noflash,
+        world_first, world_second, world_third, world_fourth, world_nshots, world_shots, shard, num_shards)
+    if self.m_columnar:
+      return self.columns().file_array(self._object_positions(*args))
+    rows = self._object_rows(*args)
+    dtype = [('id', numpy.int32), ('client_id', numpy.int32), ('path', string_dtype([r[2] for r in rows], 'S')),
+             ('session_id', numpy.int8), ('recording_id', numpy.int8), ('shot_id', numpy.int8),
+             ('camera_id', numpy.int8), ('expression_id', numpy.int8)]
+    return numpy.array([(r[0], r[1], r[2].encode('ascii'), r[3], r[4], -1 if r[5] is None else r[5], -1 if r[6] is None else r[6], r[7])
+        for r in rows], dtype=dtype)
+
+  def _object_positions(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras, world_sampling,
+      world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots, shard, num_shards):
+    """Returns the positions in the numpy columns of the files of objects()"""
+
+    self._refresh()
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    self._check_shard(shard, num_shards)
+    columns = self.columns()
+    positions = columns.object_positions(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+        world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots)
+    return positions if num_shards == 1 else positions[columns.m_file_id[positions] % num_shards == shard]
+
+  def _object_rows(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, subworld=None, expressions=None, cameras=None, world_sampling=1,
+      world_noflash=False, world_first=False, world_second=False, world_third=False,
+      world_fourth=False, world_nshots=None, world_shots=None, shard=0, num_shards=1):
+    """Returns the ids, client ids, paths, session ids, recording ids, shot ids,
+    camera ids and expression ids of the files of objects()"""
+
+    self._refresh()
+    protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras = \
+        self._objects_parameters(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras)
+    self._check_shard(shard, num_shards)
+    q = self._objects_query(protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras,
+        world_sampling, world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots,
+        shard=shard, num_shards=num_shards)
+    if q is None:
+      return []
+    q = q.with_entities(File.id, File.client_id, File.path, File.session_id, File.recording_id, FileMultiview.shot_id,
+          FileMultiview.camera_id, File.expression_id).outerjoin(FileMultiview, FileMultiview.id == File.id)
+    return self.m_session.execute(q.statement).fetchall()
+
+  def _objects_parameters(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras):
+    """Validates the parameters of objects()"""
+
+    metadata = self.metadata()
+    protocol = self.check_parameters_for_validity(protocol, 'protocol', metadata.protocol_names)
     purposes = self.check_parameters_for_validity(purposes, 'purpose', self.purposes())
     groups = self.check_parameters_for_validity(groups, 'group', self.groups())
     classes = self.check_parameters_for_validity(classes, 'class', ('client', 'impostor'))
     if subworld:
-      subworld = self.check_parameters_for_validity(subworld, 'subworld', self.subworld_names())
-    if expressions: expressions = self.check_parameters_for_validity(expressions, 'expression', self.expression_names())
-    if cameras: cameras = self.check_parameters_for_validity(cameras, 'camera', self.camera_names())
+      subworld = self.check_parameters_for_validity(subworld, 'subworld', metadata.subworld_names)
+    if expressions: expressions = self.check_parameters_for_validity(expressions, 'expression', metadata.expression_names)
+    if cameras: cameras = self.check_parameters_for_validity(cameras, 'camera', metadata.camera_names)
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids,collections.Iterable)):
+    elif(not isinstance(model_ids,Iterable)):
       model_ids = (model_ids,)
 
-    # Now query the database
+    return protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras
+
+  def _check_shard(self, shard, num_shards):
+    """Checks the shard parameters of objects()"""
+
+    if num_shards < 1 or not 0 <= shard < num_shards:
+      raise ValueError("The shard %d is not in the range [0, %d)" % (shard, num_shards))
+
+  def _file_list(self, fingerprint, protocol, group, purpose=None):
+    """Returns the ids of the files of the given protocol, group and purpose and
+    the ids of their clients, as the two rows of an array. Purposes are not
+    distinguished for the world group, as in objects()."""
+
+    def compute():
+      a = protocolPurpose_file_association
+      return self.query(File.id, File.client_id).join(Client).join(a, File.id == a.c.file_id).\
+            filter(a.c.protocolPurpose_id.in_(self._purpose_ids((protocol,), (group,), purpose))).distinct().order_by(File.id)
+
+    name = '%s_%s' % (protocol, group) if purpose is None else '%s_%s_%s' % (protocol, group, purpose)
+    return self.m_file_lists.get(fingerprint, name, compute)
+
+  def _objects_from_file_lists(self, protocol, purposes, model_ids, groups, classes, shard=0, num_shards=1):
+    """Selects the files for the validated parameters of objects() from the
+    persistent file lists"""
+
+    import numpy
+    fingerprint = database_fingerprint(self.m_sqlite_file)
+    model_ids = [int(m) for m in model_ids]
+
+    def clients(array):
+      return array[0, isin(array[1], model_ids)] if model_ids else array[0]
+
+    ids = []
+    for p in protocol:
+      if 'world' in groups:
+        ids.append(clients(self._file_list(fingerprint, p, 'world')))
+      for g in groups:
+        if g == 'world':
+          continue
+        if 'enroll' in purposes:
+          ids.append(clients(self._file_list(fingerprint, p, g, 'enroll')))
+        if 'probe' in purposes:
+          array = self._file_list(fingerprint, p, g, 'probe')
+          if 'client' in classes:
+            ids.append(clients(array))
+          if 'impostor' in classes:
+            ids.append(array[0, array[1] != model_ids[0]] if len(model_ids) == 1 else array[0])
+
+    if not ids:
+      return []
+    retval = self._files(_shard_ids(numpy.unique(numpy.concatenate(ids)), shard, num_shards))
+    # same order as the SQL queries, see FILE_ORDER
+    retval.sort(key=_file_order)
+    return retval
+
+  def _files(self, ids, chunk_size=500):
+    """Returns the File objects with the given ids in the given order, querying
+    them in chunks to stay below the limit of SQLite on the number of parameters"""
+
     retval = []
-    if 'world' in groups:
-      q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-                  filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup == 'world'))
+    for i in range(0, len(ids), chunk_size):
+      chunk = [int(k) for k in ids[i:i+chunk_size]]
+      files = dict((f.id, f) for f in self.query(File).filter(File.id.in_(chunk)))
+      retval += [files[k] for k in chunk]
+    return retval
+
+  def precompute(self, cache_directory = None):
+    """Stores the file lists of all protocols, groups and purposes in the
+    persistent cache, see the constructor, and removes the lists stored for
+    previous versions of the database. Returns the number of lists."""
+
+    if cache_directory:
+      self.m_file_lists = FileListCache(CACHE_DIRECTORY if cache_directory is True else cache_directory)
+    elif self.m_file_lists is None:
+      self.m_file_lists = FileListCache(CACHE_DIRECTORY)
+    fingerprint = database_fingerprint(self.m_sqlite_file)
+    self.m_file_lists.remove_stale(fingerprint)
+    count = 0
+    for p in self.protocol_names():
+      self._file_list(fingerprint, p, 'world')
+      for g in ('dev', 'eval'):
+        for purpose in ('enroll', 'probe'):
+          self._file_list(fingerprint, p, g, purpose)
+      count += 5
+    return count
+
+  def _objects(self, *args, **kwargs):
+    """Queries the files for the validated parameters of objects()"""
+
+    q = self._objects_query(*args, **kwargs)
+    return [] if q is None else list(q)
+
+  def _has_ordinals(self):
+    """Tells if the file table has the columns session_ordinal and shot_ordinal,
+    which databases created before they were added lack until they are
+    updated with 'create --update'"""
+
+    if self.m_ordinals is None:
+      columns = set(row[1] for row in self.m_session.execute("PRAGMA table_info(file)"))
+      self.m_ordinals = 'session_ordinal' in columns and 'shot_ordinal' in columns
+    return self.m_ordinals
+
+  def _objects_query(self, protocol, purposes, model_ids, groups, classes, subworld, expressions, cameras, world_sampling,
+      world_noflash, world_first, world_second, world_third, world_fourth, world_nshots, world_shots, shard=0, num_shards=1):
+    """Returns the query of the files for the validated parameters of objects(),
+    or None if no file can match"""
+
+    # the names are resolved to ids from the metadata, so that neither their
+    # tables nor the protocol (purpose) tables need to be joined
+    metadata = self.metadata()
+    expression_ids = [metadata.expression_ids[e] for e in expressions] if expressions else None
+    camera_ids = [metadata.camera_ids[c] for c in cameras] if cameras else None
+
+    def purpose_query(purpose_ids):
+      """Returns the query of the files of the given protocol purposes and expressions"""
+      q = self.query(File).join(Client).join(protocolPurpose_file_association, File.id == protocolPurpose_file_association.c.file_id).\
+            filter(protocolPurpose_file_association.c.protocolPurpose_id.in_(purpose_ids))
+      if expressions:
+        q = q.filter(File.expression_id.in_(expression_ids))
+      return q
+
+    # Now query the database: the ids of the files of each branch are combined into a single query
+    branches = []
+    world_ids = self._purpose_ids(protocol, ('world',))
+    if 'world' in groups and world_ids:
+      q = purpose_query(world_ids)
       if subworld:
         q = q.join((Subworld, Client.subworld)).filter(Subworld.name.in_(subworld))
-      if expressions:
-        q = q.join(Expression).filter(Expression.name.in_(expressions))
-      if cameras or world_nshots or world_shots or (world_sampling != 1 and world_noflash == False) or world_noflash:
+      ordinals = self._has_ordinals()
+      if cameras or (world_nshots and not ordinals) or world_shots or (world_sampling != 1 and world_noflash == False) or world_noflash:
         q = q.join(FileMultiview)
       if cameras:
-        q = q.join(Camera).filter(Camera.name.in_(cameras))
-      if world_nshots:
-        max1 = 19
-        max2 = 19
-        max3 = 19
-        max4 = 19
-        if world_nshots < 19:
-          max1 = world_nshots
-          max2 = 0
-          max3 = 0
-          max4 = 0
-        elif world_nshots < 38:
-          max2 = world_nshots - 19
-          max3 = 0
-          max4 = 0
-        elif world_nshots < 57:
-          max3 = world_nshots - 38
-          max4 = 0
-        else:
-          max4 = world_nshots - 57
+        q = q.filter(FileMultiview.camera_id.in_(camera_ids))
+      if world_nshots and ordinals:
+        # highres images have no shot ordinal
+        q = q.filter(File.shot_ordinal < world_nshots)
+      elif world_nshots:
+        max1, max2, max3, max4 = world_nshots_limits(world_nshots)
         q = q.filter(or_( and_( File.session_id == Client.first_session, or_(and_(File.recording_id == 1, FileMultiview.shot_id < max1),
                                                                              and_(File.recording_id == 2, FileMultiview.shot_id < max2))),
                           and_( File.session_id == Client.second_session, or_(and_(File.recording_id == 1, FileMultiview.shot_id < max2),
@@ -441,65 +1004,67 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
         q = q.filter(((File.client_id + FileMultiview.shot_id) % world_sampling) == 0)
       if world_noflash:
         q = q.filter(FileMultiview.shot_id == 0)
-      if world_first:
-        q = q.filter(and_(File.session_id == Client.first_session, or_(Client.first_session != 4,
-                  and_(Client.first_session == 4, File.recording_id == 1))))
-      if world_second:
-        q = q.filter(or_( and_(Client.second_session != 4, File.session_id == Client.second_session),
-                          or_( and_(Client.first_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                               and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
-      if world_third:
-        q = q.filter(or_( and_(Client.third_session != 4, File.session_id == Client.third_session),
-                          or_( and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                               and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
-      if world_fourth:
-        q = q.filter(or_( and_(Client.fourth_session != 4, File.session_id == Client.fourth_session),
-                          or_( and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
-                               and_(Client.fourth_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+      if ordinals:
+        for (n, selected) in enumerate((world_first, world_second, world_third, world_fourth), 1):
+          if selected:
+            q = q.filter(File.session_ordinal == n)
+      else:
+        # databases created before the ordinals were stored
+        if world_first:
+          q = q.filter(and_(File.session_id == Client.first_session, or_(Client.first_session != 4,
+                    and_(Client.first_session == 4, File.recording_id == 1))))
+        if world_second:
+          q = q.filter(or_( and_(Client.second_session != 4, File.session_id == Client.second_session),
+                            or_( and_(Client.first_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
+                                 and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+        if world_third:
+          q = q.filter(or_( and_(Client.third_session != 4, File.session_id == Client.third_session),
+                            or_( and_(Client.second_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
+                                 and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
+        if world_fourth:
+          q = q.filter(or_( and_(Client.fourth_session != 4, File.session_id == Client.fourth_session),
+                            or_( and_(Client.third_session == 4, and_(File.session_id == 4, File.recording_id == 2)),
+                                 and_(Client.fourth_session == 4, and_(File.session_id == 4, File.recording_id == 1)))))
       if model_ids:
         q = q.filter(Client.id.in_(model_ids))
-      q = q.order_by(File.client_id, File.session_id, File.recording_id, File.id)
-      retval += list(q)
+      branches.append(q.with_entities(File.id))
 
+    enroll_ids = self._purpose_ids(protocol, groups, 'enroll')
+    probe_ids = self._purpose_ids(protocol, groups, 'probe')
     if ('dev' in groups or 'eval' in groups):
-      if('enroll' in purposes):
-        q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'enroll'))
-        if expressions:
-          q = q.join(Expression).filter(Expression.name.in_(expressions))
+      if('enroll' in purposes) and enroll_ids:
+        q = purpose_query(enroll_ids)
         if cameras:
-          q = q.join(FileMultiview).join(Camera).filter(Camera.name.in_(cameras))
+          q = q.join(FileMultiview).filter(FileMultiview.camera_id.in_(camera_ids))
         if model_ids:
           q = q.filter(Client.id.in_(model_ids))
-        q = q.order_by(File.client_id, File.session_id, File.recording_id, File.id)
-        retval += list(q)
+        branches.append(q.with_entities(File.id))
 
-      if('probe' in purposes):
+      if('probe' in purposes) and probe_ids:
         if('client' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
-          if expressions:
-            q = q.join(Expression).filter(Expression.name.in_(expressions))
+          q = purpose_query(probe_ids)
           if cameras:
-            q = q.join(FileMultiview).join(Camera).filter(Camera.name.in_(cameras))
+            q = q.join(FileMultiview).filter(FileMultiview.camera_id.in_(camera_ids))
           if model_ids:
             q = q.filter(Client.id.in_(model_ids))
-          q = q.order_by(File.client_id, File.session_id, File.recording_id, File.id)
-          retval += list(q)
+          branches.append(q.with_entities(File.id))
 
         if('impostor' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
-          if expressions:
-            q = q.join(Expression).filter(Expression.name.in_(expressions))
+          q = purpose_query(probe_ids)
           if cameras:
-            q = q.join(FileMultiview).join(Camera).filter(Camera.name.in_(cameras))
+            q = q.join(FileMultiview).filter(FileMultiview.camera_id.in_(camera_ids))
           if len(model_ids) == 1:
             q = q.filter(not_(Client.id.in_(model_ids)))
-          q = q.order_by(File.client_id, File.session_id, File.recording_id, File.id)
-          retval += list(q)
+          branches.append(q.with_entities(File.id))
 
-    return list(set(retval)) # To remove duplicates
+    if not branches:
+      return None
+    from sqlalchemy import union
+    ids = union(*[q.statement for q in branches])
+    q = self.query(File).filter(File.id.in_(ids))
+    if num_shards > 1:
+      q = q.filter(File.id % num_shards == shard)
+    return q.order_by(*FILE_ORDER)
 
   def tobjects(self, protocol=None, model_ids=None, groups=None, expressions=None):
     """Returns a set of filenames for enrolling T-norm models for score
@@ -574,6 +1139,149 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
       zgroups.append('dev')
     return self.objects(protocol, 'probe', model_ids, zgroups, 'client', None, expressions)
 
+  def objects_by_model(self, protocol=None, purposes=None, model_ids=None, groups=None,
+      classes=None, expressions=None, cameras=None):
+    """Returns the Files of objects() for many models at once.
+
+    The result is the same as calling objects(protocol, purposes, model_id,
+    groups, classes, expressions=expressions, cameras=cameras) for each of the
+    models, but the files are queried only once per purpose and distributed
+    over the models afterwards.
+
+    Keyword Parameters:
+
+    model_ids
+      The model ids (client ids) to retrieve the files for. If 'None' is given
+      (this is the default), all models of the given groups are considered.
+
+    groups
+      The groups to which the models belong ('dev', 'eval') or a tuple with
+      both of them.
+
+    The other parameters are the ones of objects().
+
+    Returns: A dictionary with the list of Files for each model id, in the order
+    of the model ids.
+    """
+
+    groups = self.check_parameters_for_validity(groups, "group", ('dev', 'eval'))
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ('enroll', 'probe'))
+    classes = self.check_parameters_for_validity(classes, "class", ('client', 'impostor'))
+    model_ids = self._model_ids_parameter(model_ids, lambda: self.model_ids(protocol, groups))
+
+    enroll = self.objects(protocol, 'enroll', None, groups, None, None, expressions, cameras) if 'enroll' in purposes else []
+    retval = self._files_by_model(model_ids, enroll)
+    if 'probe' not in purposes:
+      return retval
+
+    probes = self.objects(protocol, 'probe', None, groups, None, None, expressions, cameras)
+    own = self._files_by_model(model_ids, probes)
+    for model_id in model_ids:
+      # as objects() does for a single model id, the impostor probes exclude the model's own probes
+      if 'impostor' not in classes:
+        selected = own[model_id]
+      elif 'client' not in classes:
+        selected = [f for f in probes if f.client_id != model_id]
+      else:
+        selected = list(probes)
+      if retval[model_id]:
+        selected = sorted(dict((f.id, f) for f in retval[model_id] + selected).values(), key=_file_order)
+      retval[model_id] = selected
+    return retval
+
+  def trials(self, protocol=None, groups='dev', expressions=None, cameras=None, packed=False):
+    """Returns all trials of the given protocol and groups, i.e., each model
+    compared with each probe file, as a Trials tuple of numpy arrays.
+
+    Keyword Parameters:
+
+    protocol, groups, expressions, cameras
+      As for objects(); groups is one of ('dev', 'eval') or a tuple with both.
+
+    packed
+      If True, the rows of the genuine matrix are packed into bits with
+      numpy.packbits(); numpy.unpackbits(genuine, axis=1)[:,:len(probe_ids)]
+      restores them.
+
+    Returns: A Trials tuple with the model ids, the probe file ids (in the order
+    of objects()), the client ids of the probe files and the boolean matrix
+    whose element [i,j] is True if the probe j belongs to the model i, i.e., is
+    a genuine trial, and False for an impostor trial.
+    """
+
+    import numpy
+    model_ids, probe_ids, probe_client_ids = self._trial_columns(protocol, groups, expressions, cameras)
+    genuine = model_ids[:,numpy.newaxis] == probe_client_ids[numpy.newaxis,:]
+    if packed:
+      genuine = numpy.packbits(genuine, axis=1)
+    return Trials(model_ids, probe_ids, probe_client_ids, genuine)
+
+  def trial_blocks(self, protocol=None, groups='dev', shard_index=0, n_shards=1, block_size=65536, expressions=None, cameras=None):
+    """Yields the trials of trials() in blocks, without building all of them.
+
+    The trials are split into n_shards shards of consecutive models and probes
+    of balanced sizes (see trials.plan_shards()), and only the trials of the
+    shard with the given index are yielded. Each job of a distributed scoring
+    can thus compute its own shard from the same parameters, without any
+    coordination. The union of all shards is exactly the trials of trials().
+
+    Yields: Tuples of three numpy arrays with block_size elements (the last one
+    may be shorter): the model ids, the probe file ids and whether the trials
+    are genuine. The trials are ordered by model and probe.
+    """
+
+    from .trials import shard, iter_blocks
+    model_ids, probe_ids, probe_client_ids = self._trial_columns(protocol, groups, expressions, cameras)
+    bounds = shard(len(model_ids), len(probe_ids), shard_index, n_shards)
+    return iter_blocks(model_ids, probe_ids, probe_client_ids, bounds, block_size)
+
+  def _trial_columns(self, protocol, groups, expressions, cameras):
+    """Returns the model ids, the probe ids and the client ids of the probes of
+    trials() as numpy arrays"""
+
+    import numpy
+    groups = self.check_parameters_for_validity(groups, "group", ('dev', 'eval'))
+    model_ids = numpy.array(self.model_ids(protocol, groups), dtype=numpy.int32)
+    probes = self.objects_array(protocol, 'probe', None, groups, None, None, expressions, cameras)
+    return model_ids, probes['id'].copy(), probes['client_id'].copy()
+
+  def tobjects_by_model(self, protocol=None, model_ids=None, groups=None, expressions=None):
+    """Returns the Files of tobjects() for many T-Norm models at once, as a
+    dictionary with the list of Files for each model id. If model_ids is
+    'None' (this is the default), all T-Norm models of the groups are
+    considered. The files are queried only once."""
+
+    model_ids = self._model_ids_parameter(model_ids, lambda: self.tmodel_ids(protocol, groups))
+    return self._files_by_model(model_ids, self.tobjects(protocol, None, groups, expressions))
+
+  def zobjects_by_model(self, protocol=None, model_ids=None, groups=None, expressions=None):
+    """Returns the Files of zobjects() for many Z-Norm clients at once, as a
+    dictionary with the list of Files for each client id. If model_ids is
+    'None' (this is the default), all Z-Norm clients of the groups are
+    considered. The files are queried only once."""
+
+    model_ids = self._model_ids_parameter(model_ids, lambda: [client.id for client in self.zclients(protocol, groups)])
+    return self._files_by_model(model_ids, self.zobjects(protocol, None, groups, expressions))
+
+  def _model_ids_parameter(self, model_ids, default):
+    """Returns the given model ids as a list, or default() if they are None"""
+
+    if model_ids is None:
+      return default()
+    if not isinstance(model_ids, Iterable):
+      return [model_ids]
+    return list(model_ids)
+
+  def _files_by_model(self, model_ids, files):
+    """Distributes the given Files over the given model ids by their client ids,
+    keeping their order"""
+
+    retval = collections.OrderedDict((model_id, []) for model_id in model_ids)
+    for f in files:
+      if f.client_id in retval:
+        retval[f.client_id].append(f)
+    return retval
+
   def annotations(self, file):
     """Reads the annotations for the given file id from file and returns them in a dictionary.
     Depending on the view type of the file (i.e., the camera), different annotations might be returned.
@@ -628,7 +1336,7 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def protocol_names(self):
     """Returns all registered protocol names"""
 
-    return [str(p.name) for p in self.protocols()]
+    return list(self.metadata().protocol_names)
 
   def protocols(self):
     """Returns all registered protocols"""
@@ -638,7 +1346,7 @@ class Database(bob.db.verification.utils.SQLiteDatabase, bob.db.verification.uti
   def has_protocol(self, name):
     """Tells if a certain protocol is available"""
 
-    return self.query(Protocol).filter(Protocol.name==name).count() != 0
+    return name in self.metadata().protocol_names
 
   def protocol(self, name):
     """Returns the protocol object in the database given a certain name. Raises
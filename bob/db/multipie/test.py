@@ -39,6 +39,14 @@ def db_available(test):
 
   return wrapper
 
+def memory_session():
+  """Returns a session bound to an empty in-memory Multi-PIE database"""
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+  engine = create_engine('sqlite://')
+  bob.db.multipie.models.Base.metadata.create_all(engine)
+  return sessionmaker(bind=engine)()
+
 
 @db_available
 def test_clients():
@@ -89,6 +97,13 @@ def test_protocols():
   assert len(db.subworlds()) == 4
   assert len(db.subworld_names()) == 4
   assert db.has_subworld('sub41')
+  assert not db.has_subworld('sub42')
+  # names are read once and served from the metadata afterwards
+  assert db.metadata() is db.metadata()
+  assert db.subworld_names() == [s.name for s in db.subworlds()]
+  assert db.camera_names() == [c.name for c in db.cameras()]
+  assert db.metadata().camera_ids == dict((c.name, c.id) for c in db.cameras())
+  assert len(db.metadata().purpose_ids) == len(db.protocol_purposes())
 
 
 @db_available
@@ -102,6 +117,114 @@ def test_objects():
   assert len(db.zobjects()) > 0
   assert len(db.tobjects()) > 0
 
+  # no duplicates, in a fixed order
+  files = db.objects()
+  keys = [(f.client_id, f.session_id, f.recording_id, f.id) for f in files]
+  assert keys == sorted(set(keys))
+  assert [f.id for f in db.iter_objects(batch_size=100)] == [f.id for f in files]
+  # streaming does not detach the Files returned before
+  assert files[0].client.id == files[0].client_id
+
+  # the shards together are the unsharded files, and the pages too
+  shards = [db.objects(shard=i, num_shards=3) for i in range(3)]
+  assert sorted(f.id for s in shards for f in s) == sorted(f.id for f in files)
+  assert [f.id for f in shards[1]] == [f.id for f in files if f.id % 3 == 1]
+  pages = [db.objects_page(limit=500)]
+  while pages[-1]:
+    pages.append(db.objects_page(after=pages[-1][-1], limit=500))
+  assert [f.id for p in pages for f in p] == [f.id for f in files]
+
+  # the same files as plain rows
+  rows = db.objects_rows()
+  assert [r.id for r in rows] == [f.id for f in files]
+  assert rows[0].make_path('/tmp', '.png') == files[0].make_path('/tmp', '.png')
+  array = db.objects_array()
+  assert list(array['id']) == [f.id for f in files]
+  assert array['path'][0].decode() == files[0].path
+  assert array['expression_id'][0] == db.metadata().expression_ids[rows[0].expression]
+  assert list(db.clients_array(groups='dev')['id']) == db.model_ids(groups='dev')
+  # with the positional parameters of objects()
+  assert [r.id for r in db.objects_rows('M', 'probe', None, 'dev')] == [f.id for f in db.objects('M', 'probe', None, 'dev')]
+  assert list(db.objects_array(None, None, None, 'world', None, None, None, '05_1')['id']) == [f.id for f in db.objects(groups='world', cameras='05_1')]
+
+  # the files of many models at once
+  by_model = db.objects_by_model(groups='dev')
+  assert list(by_model.keys()) == db.model_ids(groups='dev')
+  for model_id in db.model_ids(groups='dev')[:3]:
+    assert [f.id for f in by_model[model_id]] == [f.id for f in db.objects(groups='dev', model_ids=model_id)]
+    assert [f.id for f in db.tobjects_by_model(groups='eval', model_ids=[model_id])[model_id]] == [f.id for f in db.tobjects(groups='eval', model_ids=model_id)]
+
+  # the genuine trials are the client probes of each model
+  trials = db.trials(groups='dev')
+  assert list(trials.model_ids) == db.model_ids(groups='dev')
+  assert list(trials.probe_ids) == [f.id for f in db.objects(groups='dev', purposes='probe')]
+  assert list(trials.probe_ids[trials.genuine[0]]) == [f.id for f in db.objects(groups='dev', purposes='probe', classes='client', model_ids=int(trials.model_ids[0]))]
+  import numpy
+  assert (numpy.unpackbits(db.trials(groups='dev', packed=True).genuine, axis=1)[:,:len(trials.probe_ids)] == trials.genuine).all()
+  blocks = list(db.trial_blocks(groups='dev', shard_index=1, n_shards=2, block_size=100))
+  assert all(len(b[0]) == 100 for b in blocks[:-1])
+  assert sum(b[2].sum() for b in blocks) + sum(b[2].sum() for b in db.trial_blocks(groups='dev', shard_index=0, n_shards=2)) == trials.genuine.sum()
+
+  # the numpy columns give the same results as SQL
+  columnar = bob.db.multipie.Database(columnar=True)
+  assert [f.id for f in columnar.objects()] == [f.id for f in files]
+  for kwargs in ({'world_nshots' : 3}, {'world_second' : True}, {'world_sampling' : 3}, {'subworld' : 'sub41'}):
+    assert [f.id for f in columnar.objects(groups='world', **kwargs)] == [f.id for f in db.objects(groups='world', **kwargs)]
+  assert [f.id for f in columnar.zobjects(groups='dev')] == [f.id for f in db.zobjects(groups='dev')]
+  assert [c.id for c in columnar.clients(groups='world', subworld='sub81')] == [c.id for c in db.clients(groups='world', subworld='sub81')]
+  # once the objects are read, the columns answer without querying the database
+  from sqlalchemy import event
+  statements = []
+  def count(conn, cursor, statement, *args):
+    statements.append(statement)
+  event.listen(columnar.m_session.bind, 'before_cursor_execute', count)
+  try:
+    assert [f.id for f in columnar.objects(groups='dev')] == [f.id for f in db.objects(groups='dev')]
+    assert [c.id for c in columnar.clients()] == [c.id for c in db.clients()]
+  finally:
+    event.remove(columnar.m_session.bind, 'before_cursor_execute', count)
+  assert statements == []
+  # the rows and arrays from the columns are the same as from SQL
+  assert columnar.objects_rows() == rows
+  assert (columnar.objects_array(groups='world', world_nshots=3) == db.objects_array(groups='world', world_nshots=3)).all()
+
+
+@db_available
+def test_snapshot():
+
+  import tempfile, shutil, numpy, errno
+  db = bob.db.multipie.Database()
+  directory = tempfile.mkdtemp()
+  try:
+    snapshot = db.export_snapshot(os.path.join(directory, 'snapshot'))
+    mapped = bob.db.multipie.Database(snapshot=snapshot)
+    # the columns are memory-mapped, not copied
+    assert isinstance(mapped.columns().m_file_id, numpy.memmap)
+    assert mapped.metadata() == db.metadata()
+    assert [f.id for f in mapped.objects(groups='dev')] == [f.id for f in db.objects(groups='dev')]
+    assert [f.id for f in mapped.objects(groups='world', world_nshots=3)] == [f.id for f in db.objects(groups='world', world_nshots=3)]
+    assert [c.id for c in mapped.clients()] == [c.id for c in db.clients()]
+    # a new export replaces the old one, without leaving temporary directories
+    assert db.export_snapshot(snapshot) == snapshot
+    assert os.listdir(directory) == ['snapshot']
+    # a snapshot that cannot be moved aside is an error, not an endless retry
+    rename = os.rename
+    def failing_rename(source, target):
+      if source == snapshot:
+        raise OSError(errno.EPERM, "Operation not permitted")
+      rename(source, target)
+    os.rename = failing_rename
+    try:
+      db.export_snapshot(snapshot)
+      assert False, "export_snapshot() did not fail"
+    except OSError as e:
+      assert e.errno == errno.EPERM
+    finally:
+      os.rename = rename
+    assert os.listdir(directory) == ['snapshot']
+  finally:
+    shutil.rmtree(directory)
+
 
 @db_available
 def test_annotations():
@@ -132,3 +255,341 @@ def test_driver_api():
   assert main('multipie reverse session02/multiview/108/01/05_1/108_02_01_051_17 --self-test'.split()) == 0
   assert main('multipie path 6578 --self-test'.split()) == 0
 
+
+def test_file_inserter():
+
+  from bob.db.multipie.create import FileInserter
+  from bob.db.multipie.models import File, FileMultiview
+
+  s = memory_session()
+  inserter = FileInserter(s, batch_size=2)
+  assert inserter.add(1, 'session01/multiview/001/01/05_1/001_01_01_051_00', 1, 1, 'multiview', 1, 0, 8) == 1
+  assert inserter.add(1, 'session01/multiview/001/01/05_1/001_01_01_051_01', 1, 1, 'multiview', 1, 1, 8) == 2
+  assert inserter.add(1, 'session01/highres/001/001_01', 1, 1, 'highres', 1) == 3
+  inserter.flush()
+  assert s.query(File).count() == 3
+  assert s.query(FileMultiview).count() == 2
+  assert s.query(FileMultiview).filter(FileMultiview.id == 2).one().shot_id == 1
+
+  # ids continue after the ones already stored
+  assert FileInserter(s).add(2, 'session01/highres/002/002_01', 1, 1, 'highres', 1) == 4
+
+
+def test_add_ordinals():
+
+  from bob.db.multipie.create import FileInserter, add_ordinals
+  from bob.db.multipie.models import Client, File
+
+  s = memory_session()
+  # a client recorded in sessions 2 and 4
+  s.add(Client(1, 'world', 1970, 'male', 2, 4, 0, 0))
+  inserter = FileInserter(s)
+  inserter.add(1, 'session02/multiview/001/01/05_1/001_02_01_051_03', 2, 1, 'multiview', 1, 3, 8)
+  inserter.add(1, 'session02/multiview/001/02/05_1/001_02_02_051_03', 2, 2, 'multiview', 1, 3, 8)
+  inserter.add(1, 'session04/multiview/001/01/05_1/001_04_01_051_03', 4, 1, 'multiview', 1, 3, 8)
+  inserter.add(1, 'session04/multiview/001/02/05_1/001_04_02_051_03', 4, 2, 'multiview', 1, 3, 8)
+  inserter.add(1, 'session04/highres/001/001_04', 4, 1, 'highres', 1)
+  inserter.flush()
+  add_ordinals(s, 0)
+  assert [(f.session_ordinal, f.shot_ordinal) for f in s.query(File).order_by(File.id)] == [(1, 3), (1, 22), (2, 22), (3, 41), (2, None)]
+
+
+@db_available
+def test_world_without_ordinals():
+
+  # databases created before the ordinals were stored select the same files
+  db = bob.db.multipie.Database()
+  legacy = bob.db.multipie.Database()
+  legacy.m_ordinals = False
+  for kwargs in (dict(world_nshots=20), dict(world_nshots=60), dict(world_first=True), dict(world_second=True),
+                 dict(world_third=True), dict(world_fourth=True, world_nshots=5)):
+    assert [f.id for f in legacy.objects(groups='world', **kwargs)] == [f.id for f in db.objects(groups='world', **kwargs)]
+
+
+def image_tree():
+  """Creates a tiny Multi-PIE image tree (and its subject list) in a temporary directory"""
+  import tempfile
+  imagedir = tempfile.mkdtemp()
+  for client in ('001', '002', '003'):
+    for camera in ('05_1', '19_0'):
+      d = os.path.join(imagedir, 'session01', 'multiview', client, '01', camera)
+      os.makedirs(d)
+      for shot in ('00', '01'):
+        open(os.path.join(d, '%s_01_01_%s_%s.png' % (client, camera.replace('_', ''), shot)), 'w').close()
+    os.makedirs(os.path.join(imagedir, 'session01', 'highres', client))
+    open(os.path.join(imagedir, 'session01', 'highres', client, '%s_01.jpg' % client), 'w').close()
+  open(os.path.join(imagedir, 'session01', 'multiview', '.hidden'), 'w').close()
+  with open(imagedir + '.txt', 'w') as f:
+    f.write('001 1970 Male 1 0 0 0\n002 1971 Female 1 0 0 0\n003 1972 Male 1 0 0 0\n')
+  return imagedir
+
+def remove_image_tree(imagedir):
+  import shutil
+  shutil.rmtree(imagedir)
+  os.unlink(imagedir + '.txt')
+
+
+def test_crawler():
+
+  from bob.db.multipie.crawler import crawl, parse_path
+
+  r = parse_path(os.path.join('session02', 'multiview', '108', '01', '05_1', '108_02_01_051_17'))
+  assert (r.img_type, r.session_id, r.client_id, r.recording_id, r.camera_name, r.shot_id) == ('multiview', 2, 108, 1, '05_1', 17)
+  r = parse_path(os.path.join('session01', 'highres', '108', '108_01'))
+  assert (r.img_type, r.session_id, r.client_id, r.recording_id, r.camera_name, r.shot_id) == ('highres', 1, 108, 1, None, None)
+
+  imagedir = image_tree()
+  try:
+    records = list(crawl(imagedir))
+    assert len(records) == 15
+    assert len(list(crawl(imagedir, poses=False, highresolutions=False))) == 6
+    # the crawling threads keep the sequential order
+    assert list(crawl(imagedir, threads=4)) == records
+    assert list(crawl(imagedir, jobs=2)) == records
+
+    # the manifest gives back the same records, without crawling
+    from bob.db.multipie.crawler import tree_checksum, read_manifest, write_manifest
+    manifest = imagedir + '.gz'
+    checksum = tree_checksum(imagedir)
+    assert list(write_manifest(manifest, crawl(imagedir), checksum)) == records
+    stored, read = read_manifest(manifest)
+    assert stored == checksum
+    assert list(read) == records
+    # concurrent writers use temporary files of their own; the last one wins
+    first, second = write_manifest(manifest, iter(records), checksum), write_manifest(manifest, iter(records[:3]), checksum)
+    next(first)
+    assert list(second) == records[:3]
+    assert len(list(first)) == len(records) - 1
+    assert list(read_manifest(manifest)[1]) == records
+    # an abandoned manifest is not written
+    partial = write_manifest(manifest, iter(records[:3]), checksum)
+    next(partial)
+    partial.close()
+    assert list(read_manifest(manifest)[1]) == records
+    assert [n for n in os.listdir(os.path.dirname(manifest)) if n.startswith(os.path.basename(manifest) + '.')] == []
+    os.unlink(manifest)
+  finally:
+    remove_image_tree(imagedir)
+
+
+def test_update():
+
+  from bob.db.multipie.crawler import crawl
+  from bob.db.multipie.create import add_clients, add_files, add_protocols
+  from bob.db.multipie.models import File, Protocol, protocolPurpose_file_association
+
+  def links(s):
+    return s.query(protocolPurpose_file_association).count()
+
+  imagedir = image_tree()
+  try:
+    # the complete database in one go
+    full = memory_session()
+    add_clients(full, imagedir + '.txt', 0)
+    add_files(full, crawl(imagedir), True, True, False, False, 0)
+    add_protocols(full, True, True, False, False, 0)
+
+    # the illumination database, updated with poses
+    s = memory_session()
+    add_clients(s, imagedir + '.txt', 0)
+    assert add_files(s, crawl(imagedir), True, False, False, False, 0) == 1
+    add_protocols(s, True, False, False, False, 0)
+    assert s.query(File).count() == 6
+    first_file_id = add_files(s, crawl(imagedir), True, True, False, False, 0)
+    assert first_file_id == 7
+    add_protocols(s, True, True, False, False, 0, first_file_id)
+    assert s.query(File).count() == full.query(File).count() == 12
+    assert s.query(Protocol).count() == full.query(Protocol).count()
+    assert links(s) == links(full)
+
+    # nothing is missing anymore
+    assert add_files(s, crawl(imagedir), True, True, False, False, 0) is None
+    add_clients(s, imagedir + '.txt', 0)
+    assert s.query(File).count() == 12
+  finally:
+    remove_image_tree(imagedir)
+
+
+def test_in_memory():
+
+  import argparse, tempfile, shutil, sqlite3
+  from bob.db.multipie import create
+  from bob.db.multipie.models import Client
+
+  directory = tempfile.mkdtemp()
+  try:
+    dbfile = os.path.join(directory, 'db.sql3')
+    open(dbfile, 'w').write('to be replaced')
+    args = argparse.Namespace(verbose=0, update=False, files=[dbfile])
+
+    # built in memory and renamed over the existing file
+    s = create.memory_session(args)
+    s.add(Client(1, 'world', 1970, 'male', 1, 0, 0, 0))
+    s.commit()
+    create.save_database(s, dbfile, 0)
+    assert os.listdir(directory) == ['db.sql3']
+    assert sqlite3.connect(dbfile).execute('SELECT id FROM client').fetchall() == [(1,)]
+
+    # updates start with the content of the file
+    args.update = True
+    s = create.memory_session(args)
+    assert s.query(Client).count() == 1
+    s.add(Client(2, 'dev', 1971, 'female', 1, 2, 0, 0))
+    s.commit()
+    create.save_database(s, dbfile, 0, optimized=False)
+    assert os.listdir(directory) == ['db.sql3']
+    assert sqlite3.connect(dbfile).execute('SELECT id FROM client ORDER BY id').fetchall() == [(1,), (2,)]
+
+    # the copy without the backup API of python < 3.7
+    class Connection(object):
+      def __init__(self, connection):
+        self.iterdump = connection.iterdump
+    target = sqlite3.connect(':memory:')
+    create.copy_database(Connection(sqlite3.connect(dbfile)), target)
+    assert target.execute('SELECT COUNT(*) FROM client').fetchone() == (2,)
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_optimize():
+
+  from bob.db.multipie.create import create_indexes, optimize, raw_connection
+
+  s = memory_session()
+  # all declared indexes are created together with the tables
+  s.execute('DROP INDEX ix_file_expression')
+  create_indexes(s, 0)
+  names = [name for (name,) in s.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+  assert 'ix_file_expression' in names
+  assert 'ix_protocolPurpose_file_association_purpose_file' in names
+  s.commit()
+  optimize(raw_connection(s), 0)
+
+
+def test_subworlds():
+
+  from bob.db.multipie.create import add_clients, add_subworlds, read_subworlds
+  from bob.db.multipie.models import Subworld
+
+  imagedir = image_tree()
+  try:
+    with open(imagedir + '.sub', 'w') as f:
+      f.write('# custom splits\nsub2 1 3\n\nsub3 1 2 3 # all of them\n')
+    subworlds = read_subworlds(imagedir + '.sub')
+    os.unlink(imagedir + '.sub')
+    assert subworlds == [('sub2', [1, 3]), ('sub3', [1, 2, 3])]
+
+    s = memory_session()
+    add_clients(s, imagedir + '.txt', 0)
+    add_subworlds(s, 0, subworlds)
+    assert [c.id for c in s.query(Subworld).filter(Subworld.name == 'sub2').one().clients] == [1, 3]
+    # existing subworlds are kept
+    add_subworlds(s, 0, subworlds[:1] + [('sub1', [2])])
+    assert s.query(Subworld).count() == 3
+  finally:
+    remove_image_tree(imagedir)
+
+
+def test_variant():
+
+  import argparse
+  from bob.db.multipie.create import variant
+
+  assert variant('/tmp/pose.sql3:PEH') == ('/tmp/pose.sql3', 'PEH')
+  assert variant('/tmp/illumination.sql3') == ('/tmp/illumination.sql3', '')
+  # anything else than the flags is part of the file name
+  assert variant('/tmp/a:b.sql3') == ('/tmp/a:b.sql3', '')
+  try:
+    variant(':P')
+    assert False
+  except argparse.ArgumentTypeError:
+    pass
+
+
+def test_profiler():
+
+  from bob.db.multipie.profiling import Profiler
+  from bob.db.multipie.models import Client
+
+  profiler = Profiler()
+  profiler.start()
+  try:
+    s = memory_session()
+    with profiler.phase('clients') as p:
+      s.add(Client(1, 'world', 1970, 'male', 1, 0, 0, 0))
+      s.commit()
+      p['rows'] = 1
+    with profiler.phase('crawl') as p:
+      assert list(profiler.timed(range(3), p, 'crawl_seconds')) == [0, 1, 2]
+  finally:
+    profiler.stop()
+
+  report = profiler.report()
+  assert [p['name'] for p in report['phases']] == ['clients', 'crawl']
+  assert report['phases'][0]['statements'] >= 1
+  assert report['phases'][0]['rows'] == 1
+  assert report['phases'][1]['statements'] == 0
+  assert 'crawl_seconds' in report['phases'][1]
+
+
+def test_lru_cache():
+
+  from bob.db.multipie.cache import LRUCache
+
+  cache = LRUCache(2, max_objects=5)
+  assert cache.get('a', lambda: [1, 2]) == [1, 2]
+  assert cache.get('b', lambda: [3]) == [3]
+  assert cache.get('a', lambda: None) == [1, 2]
+  # 'b' is the least recently used one
+  assert cache.get('c', lambda: [4]) == [4]
+  assert cache.get('b', lambda: [5]) == [5]
+  # results are copies
+  cache.get('b', lambda: None).append(6)
+  assert cache.get('b', lambda: None) == [5]
+  # evicts 'c' to stay within 5 objects
+  cache.get('d', lambda: [1, 2, 3, 4])
+  info = cache.info()
+  assert info['entries'] == 2 and info['objects'] == 5
+  assert (info['hits'], info['misses']) == (3, 5)
+
+
+def test_file_list_cache():
+
+  import tempfile, shutil
+  from bob.db.multipie.cache import FileListCache, database_fingerprint
+
+  directory = tempfile.mkdtemp()
+  try:
+    cache = FileListCache(directory)
+    array = cache.get('0123456789abcdef', 'M_dev_probe', lambda: [(1, 2), (3, 4)])
+    assert array.tolist() == [[1, 3], [2, 4]]
+    # the second time, the list is read from disk
+    assert cache.get('0123456789abcdef', 'M_dev_probe', lambda: []).tolist() == [[1, 3], [2, 4]]
+    assert cache.get('0123456789abcdef', 'M_world', lambda: []).shape == (2, 0)
+    cache.remove_stale('fedcba9876543210')
+    assert os.listdir(directory) == []
+
+    dbfile = os.path.join(directory, 'db.sql3')
+    open(dbfile, 'wb').write(b'SQLite format 3\x00' + b'\x00' * 84)
+    fingerprint = database_fingerprint(dbfile)
+    open(dbfile, 'ab').write(b'\x00')
+    assert database_fingerprint(dbfile) != fingerprint
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_trial_shards():
+
+  import numpy
+  from bob.db.multipie.trials import plan_shards, shard
+
+  for n_models, n_probes, n_shards in ((65, 5000, 64), (64, 69, 7), (3, 2, 10)):
+    plan = plan_shards(n_models, n_probes, n_shards)
+    assert plan == [shard(n_models, n_probes, i, n_shards) for i in range(n_shards)]
+    # each trial belongs to exactly one shard
+    count = numpy.zeros((n_models, n_probes), int)
+    for model_start, model_stop, probe_start, probe_stop in plan:
+      count[model_start:model_stop, probe_start:probe_stop] += 1
+    assert (count == 1).all()
+  sizes = [(b - a) * (d - c) for (a, b, c, d) in plan_shards(65, 5000, 64)]
+  assert max(sizes) - min(sizes) <= 5000 // 8 + 65 // 8
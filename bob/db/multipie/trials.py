@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Laurent El Shafey <Laurent.El-Shafey@idiap.ch>
+#
+# Copyright (C) 2011-2013 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Partitioning of the trials (model x probe comparisons) of a protocol into
+shards and blocks, e.g., to distribute the scoring over several machines.
+"""
+
+import math
+import numpy
+
+def _split(count, parts, index):
+  """Returns the start and stop of the given part of range(count), split into
+     parts that differ by at most one element"""
+  return count * index // parts, count * (index + 1) // parts
+
+def shard_grid(n_models, n_probes, n_shards):
+  """Returns the number of model ranges and probe ranges, whose product is
+     n_shards, that split the n_models x n_probes trials into shards that are
+     as close to square as possible"""
+
+  def cost(rows):
+    columns = n_shards // rows
+    # shards without any model or probe only if unavoidable
+    empty = rows > n_models or columns > n_probes
+    return (empty, abs(math.log(float(max(n_models, 1)) * columns / (max(n_probes, 1) * rows))))
+
+  rows = min([r for r in range(1, n_shards + 1) if n_shards % r == 0], key=cost)
+  return rows, n_shards // rows
+
+def plan_shards(n_models, n_probes, n_shards):
+  """Splits the n_models x n_probes trials into n_shards balanced shards of
+     consecutive models and probes. Returns a list with the
+     (model_start, model_stop, probe_start, probe_stop) of each shard."""
+
+  if n_shards < 1:
+    raise ValueError("The number of shards must be positive, not %d" % n_shards)
+  rows, columns = shard_grid(n_models, n_probes, n_shards)
+  return [_split(n_models, rows, r) + _split(n_probes, columns, c) for r in range(rows) for c in range(columns)]
+
+def shard(n_models, n_probes, shard_index, n_shards):
+  """Returns the (model_start, model_stop, probe_start, probe_stop) of the
+     given shard of plan_shards(), without planning the others"""
+
+  if not 0 <= shard_index < n_shards:
+    raise ValueError("The shard index %d is not in the range [0, %d)" % (shard_index, n_shards))
+  rows, columns = shard_grid(n_models, n_probes, n_shards)
+  return _split(n_models, rows, shard_index // columns) + _split(n_probes, columns, shard_index % columns)
+
+def iter_blocks(model_ids, probe_ids, probe_client_ids, bounds, block_size):
+  """Yields the trials of the shard with the given bounds in blocks of
+     block_size trials (only the last one may be smaller), as arrays of the
+     model ids, the probe ids and whether the trials are genuine. The trials
+     are ordered by model, so that consecutive trials share the model."""
+
+  model_start, model_stop, probe_start, probe_stop = bounds
+  width = probe_stop - probe_start
+  total = (model_stop - model_start) * width
+  for start in range(0, total, block_size):
+    k = numpy.arange(start, min(start + block_size, total))
+    models = model_ids[model_start + k // width]
+    probes = probe_start + k % width
+    yield models, probe_ids[probes], models == probe_client_ids[probes]